@@ -0,0 +1,77 @@
+"""Compares the precompiled body cleaner with the original regex passes on the stored email bodies.
+
+Usage:
+    python -m benchmarks.benchmark_body_cleaner [--database-url URL] [--scale N] [--rounds N]
+
+--scale repeats every body N times to mimic multi-hundred-KB HTML newsletters.
+"""
+import argparse
+import os
+import statistics
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import Session
+
+from database.engine import close_database_engine, create_database_engine
+from entities.Email import Email
+from email_processing.body_cleaner import clean_body, clean_body_stream
+from email_processing.gmail_interactions import clean_newsletter_body, remove_emojis
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def load_corpus(database_url, scale):
+    """Loads every stored email body, each repeated `scale` times. Databases that have not been
+    migrated to email_bodies yet are read from the inline column; the database is not changed."""
+    engine = create_database_engine(database_url)
+    body_column = Email.body if inspect(engine).has_table("email_bodies") else Email.inline_body
+    with Session(engine) as session:
+        bodies = [body * scale for body in session.scalars(select(body_column)) if body]
+    close_database_engine(engine)
+    return bodies
+
+def original_cleaner(text):
+    return clean_newsletter_body(remove_emojis(text))
+
+def streamed_cleaner(text):
+    chunks = (text[start:start + STREAM_CHUNK_SIZE] for start in range(0, len(text), STREAM_CHUNK_SIZE))
+    return "".join(clean_body_stream(chunks))
+
+def time_cleaner(cleaner, bodies, rounds):
+    """Returns the median wall-clock seconds to clean the whole corpus once."""
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for body in bodies:
+            cleaner(body)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def main():
+    load_dotenv("config/environment_variables.env")
+    parser = argparse.ArgumentParser(description="Benchmark the newsletter body cleaners.")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Database to read the email bodies from.")
+    parser.add_argument("--scale", type=int, default=1, help="Repeat every body this many times.")
+    parser.add_argument("--rounds", type=int, default=5, help="Timed rounds per cleaner; the median is reported.")
+    args = parser.parse_args()
+
+    bodies = load_corpus(args.database_url, args.scale)
+    if not bodies:
+        print("No email bodies found.")
+        return
+
+    total_bytes = sum(len(body.encode("utf-8")) for body in bodies)
+    print(f"Corpus: {len(bodies)} bodies, {total_bytes / 1024:.0f} KB, largest {max(len(body) for body in bodies) / 1024:.0f} KB")
+
+    baseline = time_cleaner(original_cleaner, bodies, args.rounds)
+    for name, cleaner in [("original (7 passes)", original_cleaner), ("clean_body", clean_body), ("clean_body_stream", streamed_cleaner)]:
+        seconds = baseline if cleaner is original_cleaner else time_cleaner(cleaner, bodies, args.rounds)
+        print(f"{name:<22} {seconds * 1000:9.1f} ms  {total_bytes / seconds / 1024 / 1024:7.1f} MB/s  {baseline / seconds:5.2f}x")
+
+    mismatches = sum(original_cleaner(body) != clean_body(body) for body in bodies)
+    stream_mismatches = sum(streamed_cleaner(body) != clean_body(body) for body in bodies)
+    print(f"Output differs from the original on {mismatches} bodies; streamed output differs from clean_body on {stream_mismatches}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Measures what compressed storage does to the size and the read/write speed of our SQLite database.
+
+Usage:
+    python -m benchmarks.benchmark_compression [--database-url URL] [--scale N] [--rounds N]
+
+Works on temporary copies, the database itself is never modified. The copy gets the compression
+and body store migrations, so the email bodies are read from email_bodies. --scale repeats the
+stored bodies N times in the read/write test to mimic a larger archive.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import Column, Integer, MetaData, Table, Text, insert, inspect, select, text
+from sqlalchemy.engine import make_url
+
+from database.engine import close_database_engine, create_database_engine
+from database.migrations import COMPRESSED_COLUMNS, compress_existing_rows, move_bodies_to_body_store
+from database.types import CompressedText
+
+# emails.body is empty once migration 4 has moved the bodies to email_bodies
+REPORTED_COLUMNS = COMPRESSED_COLUMNS + [("email_bodies", "body")]
+
+def vacuum(engine):
+    """Rewrites the database file so freed pages no longer count towards its size."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM"))
+
+def get_column_bytes(engine):
+    """Returns the stored bytes per compressed column, as SQLite sees them. Missing tables count as 0."""
+    with engine.connect() as connection:
+        tables = set(inspect(connection).get_table_names())
+        return {
+            f"{table}.{column}": connection.execute(text(f"SELECT COALESCE(SUM(LENGTH(CAST({column} AS BLOB))), 0) FROM {table}")).scalar()
+            if table in tables else 0
+            for table, column in REPORTED_COLUMNS
+        }
+
+def measure_migration(database_path, work_dir):
+    """Compresses a copy of the database and moves its bodies to email_bodies, prints the file and
+    column sizes before and after and returns the path of the migrated copy."""
+    copy_path = os.path.join(work_dir, "migrated.db")
+    shutil.copyfile(database_path, copy_path)
+    engine = create_database_engine(f"sqlite:///{copy_path}")
+    vacuum(engine)
+    size_before, columns_before = os.path.getsize(copy_path), get_column_bytes(engine)
+
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        compress_existing_rows(connection)
+        move_bodies_to_body_store(connection)
+    seconds = time.perf_counter() - start
+    vacuum(engine)
+    close_database_engine(engine)
+    engine = create_database_engine(f"sqlite:///{copy_path}")
+    size_after, columns_after = os.path.getsize(copy_path), get_column_bytes(engine)
+    close_database_engine(engine)
+
+    print(f"Migration on a copy took {seconds * 1000:.1f} ms")
+    print(f"{'database file':<22} {size_before / 1024:9.0f} KB -> {size_after / 1024:7.0f} KB  ({size_after / size_before:5.1%})")
+    for name, before in columns_before.items():
+        after = columns_after[name]
+        ratio = f"{after / before:5.1%}" if before else "  new"
+        print(f"{name:<22} {before / 1024:9.0f} KB -> {after / 1024:7.0f} KB  ({ratio})")
+    return copy_path
+
+def load_corpus(database_path, scale):
+    """Loads every distinct email body from email_bodies through the compressed type, each repeated `scale` times."""
+    engine = create_database_engine(f"sqlite:///{database_path}")
+    bodies_table = Table("email_bodies", MetaData(), Column("body", CompressedText))
+    with engine.connect() as connection:
+        bodies = [body for body in connection.execute(select(bodies_table.c.body)).scalars() if body]
+    close_database_engine(engine)
+    return bodies * scale
+
+def time_round_trip(column_type, bodies, work_dir, rounds):
+    """Writes and reads the corpus in a scratch database and returns median write s, median read s and file size."""
+    write_timings, read_timings = [], []
+    for round_number in range(rounds):
+        path = os.path.join(work_dir, f"{column_type.__name__}-{round_number}.db")
+        engine = create_database_engine(f"sqlite:///{path}")
+        table = Table("bodies", MetaData(), Column("id", Integer, primary_key=True), Column("body", column_type))
+        table.create(engine)
+
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(insert(table), [{"body": body} for body in bodies])
+        write_timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            for _ in connection.execute(select(table.c.body)).scalars():
+                pass
+        read_timings.append(time.perf_counter() - start)
+
+        close_database_engine(engine)
+        size = os.path.getsize(path)
+    return statistics.median(write_timings), statistics.median(read_timings), size
+
+def main():
+    load_dotenv("config/environment_variables.env")
+    parser = argparse.ArgumentParser(description="Benchmark compressed text storage.")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="SQLite database to copy.")
+    parser.add_argument("--scale", type=int, default=20, help="Repeat the corpus this many times in the read/write test.")
+    parser.add_argument("--rounds", type=int, default=5, help="Timed rounds per column type; the median is reported.")
+    args = parser.parse_args()
+
+    url = make_url(args.database_url)
+    if url.get_backend_name() != "sqlite" or not url.database:
+        print("This benchmark works on copies of a SQLite database file.")
+        return
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        copy_path = measure_migration(url.database, work_dir)
+
+        bodies = load_corpus(copy_path, args.scale)
+        if not bodies:
+            print("No email bodies found.")
+            return
+        total_bytes = sum(len(body.encode("utf-8")) for body in bodies)
+        print(f"\nRead/write test: {len(bodies)} bodies, {total_bytes / 1024:.0f} KB of text")
+
+        baseline = None
+        for name, column_type in [("Text", Text), ("CompressedText", CompressedText)]:
+            write_seconds, read_seconds, size = time_round_trip(column_type, bodies, work_dir, args.rounds)
+            baseline = baseline or size
+            print(f"{name:<15} write {write_seconds * 1000:8.1f} ms  read {read_seconds * 1000:8.1f} ms  file {size / 1024:8.0f} KB ({size / baseline:5.1%})")
+
+if __name__ == "__main__":
+    main()
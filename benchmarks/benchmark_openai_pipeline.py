@@ -0,0 +1,107 @@
+"""Load-tests the OpenAI request path of the pipeline (rate limiter, response cache, retries, streaming)
+against the local stand-in, without spending tokens.
+
+Usage:
+    python -m benchmarks.openai_stand_in --latency-ms 800 --tokens-per-second 200 &
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stand-in \\
+        python -m benchmarks.benchmark_openai_pipeline [--requests N] [--concurrency N] [--async] [--stream]
+        [--passes N] [--prompt-tokens N] [--no-cache]
+
+Every pass sends the same --requests blog post requests, so passes after the first measure the
+response cache. The cache lives in the DATABASE_URL database: point it at a copy or use --no-cache.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from blog import blogpost_creator
+from database import db_operations
+from database.response_cache import cache_stats
+from enums.blogpost_subject import BlogPostSubject
+
+FILLER_SENTENCE = "Newsletter text about a product launch, a funding round and a research result. "
+
+def make_prompts(count, prompt_tokens):
+    """Returns count distinct prompts of about prompt_tokens tokens."""
+    filler = FILLER_SENTENCE * max(1, prompt_tokens * 4 // len(FILLER_SENTENCE))
+    return [f"Load test request {number}. Write the blog post in YAML.\n\n{filler}" for number in range(count)]
+
+def timed(func, *arguments):
+    """Runs func and returns (seconds, error or None)."""
+    start = time.perf_counter()
+    try:
+        func(*arguments)
+        return time.perf_counter() - start, None
+    except Exception as e:
+        return time.perf_counter() - start, e
+
+def send_request(prompt):
+    blogpost_creator.create_chat_completion(**blogpost_creator.get_blogpost_request(prompt, BlogPostSubject.AI))
+
+async def send_request_async(prompt, semaphore):
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            await blogpost_creator.create_chat_completion_async(**blogpost_creator.get_blogpost_request(prompt, BlogPostSubject.AI))
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+
+def run_pass(prompts, concurrency, use_async):
+    """Sends every prompt once and returns the (seconds, error) of each request."""
+    if use_async:
+        async def run_all():
+            semaphore = asyncio.Semaphore(concurrency)
+            return await asyncio.gather(*(send_request_async(prompt, semaphore) for prompt in prompts))
+        return asyncio.run(run_all())
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda prompt: timed(send_request, prompt), prompts))
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def main():
+    load_dotenv("config/environment_variables.env")
+    parser = argparse.ArgumentParser(description="Load-test the OpenAI request path against the local stand-in.")
+    parser.add_argument("--requests", type=int, default=20, help="Distinct requests per pass.")
+    parser.add_argument("--concurrency", type=int, default=5, help="Requests in flight at the same time.")
+    parser.add_argument("--passes", type=int, default=2, help="Times the same requests are sent.")
+    parser.add_argument("--prompt-tokens", type=int, default=2000, help="Approximate size of every prompt.")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Use AsyncOpenAI instead of threads.")
+    parser.add_argument("--stream", action="store_true", help="Stream the responses.")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the response cache.")
+    args = parser.parse_args()
+
+    blogpost_creator.STREAM_COMPLETIONS = args.stream
+    blogpost_creator.LLM_CACHE_ENABLED = not args.no_cache
+    db_operations.initialize_database()
+    prompts = make_prompts(args.requests, args.prompt_tokens)
+    print(f"{args.requests} requests x {args.passes} passes, concurrency {args.concurrency}, "
+          f"{'async' if args.use_async else 'threads'}, {'streaming' if args.stream else 'not streaming'}, "
+          f"cache {'off' if args.no_cache else 'on'}")
+
+    try:
+        for pass_number in range(1, args.passes + 1):
+            hits, misses = cache_stats["hits"], cache_stats["misses"]
+            start = time.perf_counter()
+            results = run_pass(prompts, args.concurrency, args.use_async)
+            wall_seconds = time.perf_counter() - start
+            latencies = [seconds for seconds, error in results if error is None]
+            errors = [error for _, error in results if error is not None]
+            summary = f"pass {pass_number}: {wall_seconds:7.2f} s wall, {len(results) / wall_seconds:6.1f} req/s"
+            if latencies:
+                summary += f", p50 {statistics.median(latencies) * 1000:7.0f} ms, p95 {percentile(latencies, 0.95) * 1000:7.0f} ms"
+            summary += f", {len(errors)} errors, cache {cache_stats['hits'] - hits} hits / {cache_stats['misses'] - misses} misses"
+            print(summary)
+            for error in errors[:3]:
+                print(f"    {type(error).__name__}: {error}")
+    finally:
+        db_operations.close_database()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""A local stand-in for the OpenAI chat completions and Batch API, for benchmarks and load tests without real tokens.
+
+Usage:
+    python -m benchmarks.openai_stand_in [--port 8765] [--mode synthetic|replay|record] [--fixtures DIR]
+        [--latency-ms MS] [--jitter-ms MS] [--tokens-per-second N] [--completion-tokens N]
+        [--error-rate P] [--rate-limit-rate P] [--retry-after S] [--batch-seconds S]
+
+Point the pipeline at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1 (any OPENAI_API_KEY works).
+
+Modes:
+    synthetic  Generates a response in the requested format: schema JSON, YAML for the blog post
+               prompts or plain text for the chunk summaries.
+    replay     Serves responses recorded earlier, keyed by the request parameters. Unknown requests get a 404.
+    record     Forwards every request to the real API (OPENAI_API_KEY, --upstream-base-url), stores the
+               response as a fixture and serves it.
+
+--latency-ms (+ up to --jitter-ms) passes before the first byte, --tokens-per-second paces the generation
+and streaming. --error-rate answers with a 500 and --rate-limit-rate with a 429 and Retry-After, at random.
+
+Batches (POST /v1/files, POST /v1/batches, GET /v1/batches/{id}, GET /v1/files/{id}/content) are kept in
+memory and finish --batch-seconds after they were created. Their requests are answered in the same mode,
+without the latency, and --error-rate of them end up in the error file.
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from blog.prompt_builder import count_tokens
+from database.response_cache import make_cache_key
+
+DEFAULT_FIXTURES_DIR = os.path.join("benchmarks", "fixtures", "openai")
+# Characters sent per streamed chunk, about one token
+STREAM_CHUNK_CHARACTERS = 4
+SYNTHETIC_SENTENCE = (
+    "A synthetic model release claims better reasoning at a lower price, and early testers report mixed but promising results. "
+)
+
+def get_fixture_path(fixtures_dir, request):
+    """Returns the fixture file of a request. Streaming options do not change the answer, so they are not part of the key."""
+    parameters = {key: value for key, value in request.items() if key not in ("stream", "stream_options")}
+    return os.path.join(fixtures_dir, f"{make_cache_key(parameters)}.json")
+
+def get_prompt_text(request):
+    """Returns the text of all messages of a request."""
+    return "\n".join(str(message.get("content") or "") for message in request.get("messages", []))
+
+def make_synthetic_content(request, completion_tokens):
+    """Generates a response of about completion_tokens tokens in the format the request asks for."""
+    completion_tokens = min(completion_tokens, request.get("max_tokens") or completion_tokens)
+    sentences = max(1, completion_tokens * 4 // len(SYNTHETIC_SENTENCE))
+    paragraphs = [f"<h2>Synthetic story {number}</h2>\n<p>{SYNTHETIC_SENTENCE.strip()}</p>" for number in range(1, sentences + 1)]
+    description = "A synthetic week of news, generated by the local OpenAI stand-in."
+    tags = ["OpenAI", "Stand-in"]
+
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return json.dumps({"description": description, "tags": tags, "content": "\n".join(paragraphs)})
+    if "YAML" in get_prompt_text(request):
+        indented_content = "\n".join(f"  {line}" for paragraph in paragraphs for line in paragraph.split("\n"))
+        return f'description: "{description}"\ntags:\n' + "".join(f"- {tag}\n" for tag in tags) + f"content: |\n{indented_content}\n"
+    return "\n\n".join(f"News item {number}: {SYNTHETIC_SENTENCE.strip()}" for number in range(1, sentences + 1))
+
+def make_completion(request, content):
+    """Wraps content in a chat completion object with usage counted from the request and the content."""
+    prompt_tokens = count_tokens(get_prompt_text(request), request.get("model"))
+    completion_tokens = count_tokens(content, request.get("model"))
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model") or "stand-in",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+def make_chunk(completion, delta, finish_reason=None, usage=None):
+    """Returns a chat.completion.chunk of completion."""
+    choices = [] if usage is not None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    return {
+        "id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+        "model": completion["model"], "choices": choices, "usage": usage,
+    }
+
+def find_completion(settings, request):
+    """Returns the completion for the request in the configured mode and the outcome to count,
+    or (None, "missing_fixtures") if replay mode has no recorded response for it."""
+    if settings.mode == "synthetic":
+        return make_completion(request, make_synthetic_content(request, settings.completion_tokens)), None
+
+    fixture_path = get_fixture_path(settings.fixtures, request)
+    if settings.mode == "replay":
+        if not os.path.exists(fixture_path):
+            return None, "missing_fixtures"
+        with open(fixture_path, "r", encoding="utf-8") as file:
+            return json.load(file), None
+
+    completion = record_completion(request, settings.upstream_base_url)
+    os.makedirs(settings.fixtures, exist_ok=True)
+    with open(fixture_path, "w", encoding="utf-8") as file:
+        json.dump(completion, file, indent=2)
+    return completion, "recorded"
+
+def parse_multipart(content_type, body):
+    """Returns the fields of a multipart/form-data body as name -> (filename, bytes)."""
+    message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+    )
+    return {
+        part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+def record_completion(request, upstream_base_url):
+    """Sends the request to the real API without streaming and returns the completion as a dict."""
+    import openai  # Only needed when recording
+
+    upstream = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=upstream_base_url)
+    parameters = {key: value for key, value in request.items() if key not in ("stream", "stream_options")}
+    return upstream.chat.completions.create(**parameters).model_dump(mode="json")
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Handles the chat completions, models, files and batches endpoints."""
+
+    protocol_version = "HTTP/1.1"
+    settings = None
+    stats = Counter()
+    stats_lock = threading.Lock()
+    # Uploaded and generated files (id -> (metadata, bytes)) and batches (id -> batch), kept in memory
+    files = {}
+    batches = {}
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # A client closed a kept-alive connection
+
+    def count(self, outcome):
+        with self.stats_lock:
+            self.stats[outcome] += 1
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_bytes(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_body(self, status, message, error_type, headers=None):
+        self.send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": None}}, headers)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        file_match = re.search(r"/files/([\w-]+)(/content)?$", path)
+        batch_match = re.search(r"/batches/([\w-]+)$", path)
+        if path.endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "stand-in", "object": "model", "created": 0, "owned_by": "stand-in"}]})
+        elif file_match and file_match.group(1) in self.files:
+            metadata, content = self.files[file_match.group(1)]
+            if file_match.group(2):
+                self.send_bytes(200, content, "application/octet-stream")
+            else:
+                self.send_json(200, metadata)
+        elif batch_match and batch_match.group(1) in self.batches:
+            with self.stats_lock:
+                batch = dict(self.batches[batch_match.group(1)])
+            self.send_json(200, batch)
+        else:
+            self.send_error_body(404, f"Unknown path {self.path}", "invalid_request_error")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            self.create_chat_completion(json.loads(body or b"{}"))
+        elif path.endswith("/files"):
+            self.create_file(body)
+        elif path.endswith("/batches"):
+            self.create_batch(json.loads(body or b"{}"))
+        else:
+            self.send_error_body(404, f"Unknown path {self.path}", "invalid_request_error")
+
+    def create_chat_completion(self, request):
+        settings = self.settings
+        time.sleep((settings.latency_ms + random.uniform(0, settings.jitter_ms)) / 1000)
+        roll = random.random()
+        if roll < settings.rate_limit_rate:
+            self.count("rate_limited")
+            self.send_error_body(429, "Rate limit reached (stand-in).", "rate_limit_error", {"Retry-After": str(settings.retry_after)})
+            return
+        if roll < settings.rate_limit_rate + settings.error_rate:
+            self.count("errors")
+            self.send_error_body(500, "Internal error (stand-in).", "server_error")
+            return
+
+        completion, outcome = find_completion(settings, request)
+        if outcome:
+            self.count(outcome)
+        if completion is None:
+            self.send_error_body(404, f"No recorded response for this request ({os.path.basename(get_fixture_path(settings.fixtures, request))}).", "invalid_request_error")
+            return
+        try:
+            if request.get("stream"):
+                self.stream_completion(request, completion)
+            else:
+                content_tokens = completion["usage"]["completion_tokens"] if completion.get("usage") else 0
+                if settings.tokens_per_second > 0:
+                    time.sleep(content_tokens / settings.tokens_per_second)
+                self.send_json(200, completion)
+            self.count("completed")
+        except (BrokenPipeError, ConnectionResetError):
+            self.count("aborted_by_client")  # e.g. a stream the pipeline found off-format
+
+    def create_file(self, body):
+        """Stores an uploaded file, e.g. a batch input file."""
+        fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+        if "file" not in fields:
+            self.send_error_body(400, "No file in the upload.", "invalid_request_error")
+            return
+        filename, content = fields["file"]
+        purpose = fields.get("purpose", (None, b"batch"))[1].decode("utf-8")
+        self.send_json(200, self.add_file(filename or "upload.jsonl", content, purpose))
+
+    @classmethod
+    def add_file(cls, filename, content, purpose):
+        """Stores a file and returns its metadata."""
+        metadata = {
+            "id": f"file-{uuid.uuid4().hex[:24]}", "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed",
+        }
+        cls.files[metadata["id"]] = (metadata, content)
+        return metadata
+
+    def create_batch(self, request):
+        """Creates a batch of the requests in an uploaded file and processes it in the background."""
+        if request.get("input_file_id") not in self.files:
+            self.send_error_body(400, f"No file {request.get('input_file_id')}.", "invalid_request_error")
+            return
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}", "object": "batch", "endpoint": request.get("endpoint"),
+            "input_file_id": request["input_file_id"], "completion_window": request.get("completion_window", "24h"),
+            "status": "validating", "created_at": int(time.time()), "metadata": request.get("metadata"),
+            "output_file_id": None, "error_file_id": None, "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.stats_lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self.run_batch, args=(batch["id"],), daemon=True).start()
+        self.count("batches")
+        self.send_json(200, batch)
+
+    @classmethod
+    def run_batch(cls, batch_id):
+        """Answers the requests of a batch and finishes it --batch-seconds after it was created."""
+        settings = cls.settings
+        batch = cls.batches[batch_id]
+        lines = [json.loads(line) for line in cls.files[batch["input_file_id"]][1].decode("utf-8").splitlines() if line.strip()]
+        with cls.stats_lock:
+            batch.update(status="in_progress", in_progress_at=int(time.time()), request_counts={"total": len(lines), "completed": 0, "failed": 0})
+
+        output_lines, error_lines = [], []
+        for line in lines:
+            request_id = f"req_{uuid.uuid4().hex[:24]}"
+            try:
+                completion, outcome = (None, "errors") if random.random() < settings.error_rate else find_completion(settings, line["body"])
+            except Exception as e:
+                logging.error(f"Batch request {line['custom_id']} failed: {e}")
+                completion, outcome = None, "errors"
+            if completion is None:
+                message = "Internal error (stand-in)." if outcome == "errors" else "No recorded response for this request."
+                error_lines.append({"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": line["custom_id"], "response": {
+                    "status_code": 500 if outcome == "errors" else 404, "request_id": request_id,
+                    "body": {"error": {"message": message, "type": "server_error", "param": None, "code": None}},
+                }, "error": None})
+            else:
+                output_lines.append({"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": line["custom_id"], "response": {
+                    "status_code": 200, "request_id": request_id, "body": completion,
+                }, "error": None})
+
+        time.sleep(max(0.0, batch["created_at"] + settings.batch_seconds - time.time()))
+
+        def to_file(file_lines, filename):
+            if not file_lines:
+                return None
+            content = "".join(json.dumps(file_line) + "\n" for file_line in file_lines).encode("utf-8")
+            return cls.add_file(filename, content, "batch_output")["id"]
+
+        output_file_id = to_file(output_lines, f"{batch_id}_output.jsonl")
+        error_file_id = to_file(error_lines, f"{batch_id}_error.jsonl")
+        with cls.stats_lock:
+            batch.update(
+                status="completed", completed_at=int(time.time()), output_file_id=output_file_id, error_file_id=error_file_id,
+                request_counts={"total": len(lines), "completed": len(output_lines), "failed": len(error_lines)},
+            )
+            cls.stats["batch_requests"] += len(lines)
+
+    def stream_completion(self, request, completion):
+        """Sends completion as server-sent events, paced by --tokens-per-second."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_event(data):
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        content = completion["choices"][0]["message"]["content"] or ""
+        delay = 1 / self.settings.tokens_per_second if self.settings.tokens_per_second > 0 else 0
+        send_event(json.dumps(make_chunk(completion, {"role": "assistant", "content": ""})))
+        for start in range(0, len(content), STREAM_CHUNK_CHARACTERS):
+            if delay:
+                time.sleep(delay)
+            send_event(json.dumps(make_chunk(completion, {"content": content[start:start + STREAM_CHUNK_CHARACTERS]})))
+        send_event(json.dumps(make_chunk(completion, {}, completion["choices"][0].get("finish_reason") or "stop")))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_event(json.dumps(make_chunk(completion, {}, usage=completion.get("usage"))))
+        send_event("[DONE]")
+
+def create_server(settings):
+    """Creates the stand-in server for the parsed settings, serving from its own handler class."""
+    handler = type("ConfiguredStandInHandler", (StandInHandler,), {"settings": settings, "stats": Counter(), "files": {}, "batches": {}})
+    server = ThreadingHTTPServer((settings.host, settings.port), handler)
+    server.daemon_threads = True
+    return server
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completions and Batch API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mode", choices=["synthetic", "replay", "record"], default="synthetic")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES_DIR, help="Directory of recorded responses.")
+    parser.add_argument("--upstream-base-url", default="https://api.openai.com/v1", help="Real API used in record mode.")
+    parser.add_argument("--latency-ms", type=float, default=500, help="Delay before the first byte of every response.")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra delay of up to this many ms.")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Generation speed, 0 answers at once.")
+    parser.add_argument("--completion-tokens", type=int, default=400, help="Size of synthetic responses, capped by max_tokens.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds of the 429 answers.")
+    parser.add_argument("--batch-seconds", type=float, default=5.0, help="Time a batch takes from creation to completed.")
+    return parser.parse_args(arguments)
+
+def main():
+    load_dotenv("config/environment_variables.env")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    settings = parse_arguments()
+    server = create_server(settings)
+    print(f"OpenAI stand-in ({settings.mode}) on http://{settings.host}:{settings.port}/v1, stop with Ctrl+C")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Requests: {dict(server.RequestHandlerClass.stats)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from openai.types.chat import ChatCompletion
+
+import database.db_operations
+from database.db_operations import get_emails_by_gmail_ids, unit_of_work
+from entities.Openai_batch_job import OpenAIBatchJob
+from enums.blogpost_subject import BlogPostSubject
+from blog.blogpost_creator import call_openai, generate_markdown_file, get_blogpost_request, get_client, get_prompt, insert_emaillist_in_prompt, store_blogpost_from_response
+
+load_dotenv("config/environment_variables.env")
+
+# With --batch the blog post requests of a run are sent as one OpenAI batch (half the price, results
+# within BATCH_COMPLETION_WINDOW) instead of one request per subject. The batch is stored in the
+# openai_batch_jobs table and its results are collected by a later run, or by this one with --batch-wait.
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_SECONDS = float(os.getenv("OPENAI_BATCH_POLL_SECONDS", "60"))
+# Statuses after which a batch does not change anymore
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def get_custom_id(subject: BlogPostSubject, today) -> str:
+    """Returns the id of a subject's request in the batch file."""
+    return f"{today.lower()}-{subject.name.lower()}"
+
+def prepare_batch_request(subject: BlogPostSubject, gmail_ids: list, today) -> tuple:
+    """Builds the batch file line of a subject's blog post request and its manifest entry.
+    The chunk summaries of oversized weeks are still requested right away."""
+    emails = get_emails_by_gmail_ids(gmail_ids)
+    if not emails:
+        raise ValueError("No emails available for processing.")
+
+    prompt = get_prompt(subject, today)
+    final_prompt, summary_tokens = insert_emaillist_in_prompt(emails, prompt, subject)
+    parameters = get_blogpost_request(final_prompt, subject)
+    # Batch responses are never streamed
+    del parameters["stream_monitor"], parameters["label"], parameters["validate_response"]
+
+    custom_id = get_custom_id(subject, today)
+    line = {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": parameters}
+    entry = {"subject": subject.name, "gmail_ids": [email.gmail_id for email in emails], "prompt": prompt, "summary_tokens": summary_tokens}
+    return custom_id, line, entry
+
+def submit_batch(gmail_ids_by_subject: dict, subjects: list, today) -> list:
+    """Sends the blog post requests of the subjects as one batch and stores the job.
+    Returns (subject, (Gmail IDs, None)) for every subject that could not be submitted."""
+    lines, manifest, failed = [], {}, []
+    for subject in subjects:
+        try:
+            custom_id, line, entry = prepare_batch_request(subject, gmail_ids_by_subject[subject], today)
+        except Exception as e:
+            logging.error(f"Error while preparing the batch request for {subject}: {e}")
+            failed.append((subject, (list(gmail_ids_by_subject[subject]), None)))
+            continue
+        lines.append(json.dumps(line, ensure_ascii=False))
+        manifest[custom_id] = entry
+
+    if not lines:
+        return failed
+
+    try:
+        batch_file = ("\n".join(lines) + "\n").encode("utf-8")
+        input_file = call_openai(lambda: get_client().files.create(
+            file=(f"blogposts-{today.lower()}.jsonl", batch_file), purpose="batch"
+        ))
+        batch = call_openai(lambda: get_client().batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=BATCH_COMPLETION_WINDOW,
+            metadata={"edition": today},
+        ))
+        database.db_operations.insert_batch_job(OpenAIBatchJob(
+            batch_id=batch.id,
+            input_file_id=input_file.id,
+            status=batch.status,
+            edition=today,
+            manifest=json.dumps(manifest),
+            request_count=len(lines),
+        ))
+    except Exception as e:
+        logging.error(f"Error while submitting the blog post batch: {e}")
+        return failed + [(BlogPostSubject[entry["subject"]], (entry["gmail_ids"], None)) for entry in manifest.values()]
+
+    logging.info(f"Submitted batch {batch.id} with {len(lines)} blog post requests ({', '.join(entry['subject'] for entry in manifest.values())}).")
+    return failed
+
+def read_batch_file(file_id) -> list:
+    """Downloads a batch output or error file and returns its lines as dicts."""
+    if not file_id:
+        return []
+    content = call_openai(lambda: get_client().files.content(file_id))
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+def store_batch_result(batch_id, custom_id, entry: dict, response: ChatCompletion, edition):
+    """Stores the blog post of one batch response like a synchronous run would, and marks the request as
+    collected in the same transaction. Returns the Gmail IDs and the blog post."""
+    subject = BlogPostSubject[entry["subject"]]
+    with unit_of_work() as session:
+        emails = get_emails_by_gmail_ids(entry["gmail_ids"], session=session)
+        if not emails:
+            raise ValueError(f"The emails of the {subject} batch request are no longer stored.")
+        blogpost = store_blogpost_from_response(response, entry["summary_tokens"], emails, entry["prompt"], subject, edition, session)
+        blogpost_dto = generate_markdown_file(blogpost)
+        if blogpost_dto is None:
+            raise ValueError("Markdown file could not be generated.")
+        updated_blogpost = database.db_operations.update_blogpost(blogpost_dto.id, blogpost_dto, session=session)
+        database.db_operations.mark_batch_request_collected(batch_id, custom_id, updated_blogpost.id, session=session)
+    logging.info(f"Generated blog post for {subject} from a batch response.")
+    return [email.gmail_id for email in emails], updated_blogpost
+
+def collect_batch_job(batch_job: OpenAIBatchJob, batch) -> list:
+    """Stores the blog posts of a finished batch and marks the job as collected.
+    Returns (subject, (Gmail IDs, blog post or None)) for every request in the batch."""
+    responses = {}
+    for line in read_batch_file(batch.output_file_id):
+        response = line.get("response") or {}
+        if response.get("status_code") == 200:
+            responses[line["custom_id"]] = ChatCompletion.model_validate(response["body"])
+        else:
+            logging.error(f"Batch request {line.get('custom_id')} failed with status {response.get('status_code')}: {line.get('error') or response.get('body')}")
+    for line in read_batch_file(batch.error_file_id):
+        logging.error(f"Batch request {line.get('custom_id')} failed: {line.get('error') or (line.get('response') or {}).get('body')}")
+
+    results = []
+    for custom_id, entry in json.loads(batch_job.manifest).items():
+        subject = BlogPostSubject[entry["subject"]]
+        gmail_ids, blogpost = entry["gmail_ids"], None
+        if entry.get("blogpost_id"):
+            # Stored by an earlier collection of this job that did not finish, only published again
+            logging.info(f"The {subject} blog post of batch {batch_job.batch_id} was already stored.")
+            blogpost = database.db_operations.get_blogpost_by_id(entry["blogpost_id"])
+        elif custom_id not in responses:
+            logging.error(f"Batch {batch_job.batch_id} has no response for {subject} (batch {batch.status}).")
+        else:
+            try:
+                gmail_ids, blogpost = store_batch_result(batch_job.batch_id, custom_id, entry, responses[custom_id], batch_job.edition)
+            except Exception as e:
+                logging.error(f"Error while storing the batch response for {subject}: {e}")
+        results.append((subject, (gmail_ids, blogpost)))
+
+    database.db_operations.update_batch_job(
+        batch_job.batch_id, status=batch.status, output_file_id=batch.output_file_id,
+        error_file_id=batch.error_file_id, collected_at=datetime.utcnow()
+    )
+    return results
+
+def collect_batch_results(wait_seconds=0) -> list:
+    """Collects every stored batch that has finished, waiting up to wait_seconds for unfinished ones.
+    Batches that are still running are left for a later run."""
+    deadline = time.monotonic() + wait_seconds
+    results = []
+    for batch_job in database.db_operations.get_open_batch_jobs():
+        try:
+            while True:
+                batch = call_openai(lambda: get_client().batches.retrieve(batch_job.batch_id))
+                if batch.status in FINISHED_STATUSES or time.monotonic() >= deadline:
+                    break
+                time.sleep(max(0.0, min(BATCH_POLL_SECONDS, deadline - time.monotonic())))
+
+            if batch.status != batch_job.status:
+                database.db_operations.update_batch_job(batch_job.batch_id, status=batch.status)
+            if batch.status not in FINISHED_STATUSES:
+                counts = batch.request_counts
+                progress = f", {counts.completed}/{counts.total} done" if counts else ""
+                logging.info(f"Batch {batch_job.batch_id} ({batch_job.edition}) is {batch.status}{progress}. Collecting it in a later run.")
+                continue
+            logging.info(f"Batch {batch_job.batch_id} ({batch_job.edition}) is {batch.status}. Collecting the results...")
+            results.extend(collect_batch_job(batch_job, batch))
+        except Exception as e:
+            logging.error(f"Error while collecting batch {batch_job.batch_id}: {e}")
+    return results
+
+def get_pending_gmail_ids(today) -> dict:
+    """Returns subject -> Gmail IDs for the subjects that are in a batch of this edition that has not been collected yet."""
+    pending = {}
+    for batch_job in database.db_operations.get_open_batch_jobs():
+        if batch_job.edition != today:
+            continue
+        for entry in json.loads(batch_job.manifest).values():
+            pending.setdefault(BlogPostSubject[entry["subject"]], set()).update(entry["gmail_ids"])
+    return pending
+
+def generate_blogposts_in_batch(gmail_ids_by_subject: dict, subjects: list, today, wait_seconds=0) -> list:
+    """Collects the finished batches of earlier runs, submits the subjects of this run as a new batch and,
+    with wait_seconds, waits for it. Returns (subject, (Gmail IDs, blog post or None)) pairs like the synchronous modes.
+    Subjects that are only submitted or still pending have no pair, the caller keeps their emails unpublished."""
+    results = collect_batch_results()
+    # Emails fetched again while their batch was running are already in a collected blog post
+    posted_gmail_ids = {gmail_id for _, (gmail_ids, blogpost) in results if blogpost for gmail_id in gmail_ids}
+    pending_gmail_ids = get_pending_gmail_ids(today)
+
+    gmail_ids_to_submit = {}
+    for subject in subjects:
+        gmail_ids = [gmail_id for gmail_id in gmail_ids_by_subject[subject] if gmail_id not in posted_gmail_ids]
+        if subject in pending_gmail_ids:
+            # A running batch cannot be changed, its new emails go into a batch of a later run
+            new_gmail_ids = [gmail_id for gmail_id in gmail_ids if gmail_id not in pending_gmail_ids[subject]]
+            if new_gmail_ids:
+                logging.info(f"{subject} is already in a {today} batch that has not finished. Holding back its {len(new_gmail_ids)} new emails until that batch is collected.")
+            else:
+                logging.info(f"{subject} is already in a {today} batch that has not finished. Not submitting it again.")
+        elif gmail_ids:
+            gmail_ids_to_submit[subject] = gmail_ids
+        else:
+            logging.info(f"The {subject} emails are already in a blog post collected from an earlier batch.")
+    subjects = list(gmail_ids_to_submit)
+
+    if subjects:
+        results.extend(submit_batch(gmail_ids_to_submit, subjects, today))
+        if wait_seconds > 0:
+            results.extend(collect_batch_results(wait_seconds))
+    return results
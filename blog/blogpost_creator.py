@@ -1,8 +1,11 @@
+import asyncio
 import json
 import logging
 import sys
+import threading
 from jinja2 import Template
 import openai
+from openai.types.chat import ChatCompletion
 import os
 from dotenv import load_dotenv
 import yaml
@@ -14,6 +17,13 @@ from entities.BlogpostDTO import BlogPostDTO
 from entities.Blogpost_metadata import BlogPostMetadata
 from enums.blogpost_status import BlogPostStatus
 import database.db_operations
+from database.body_store import hash_body
+from database.response_cache import LLM_CACHE_ENABLED, make_cache_key
+from blog.story_deduplication import deduplicate_stories
+from blog.prompt_builder import CHUNK_SUMMARY_MAX_TOKENS, build_prompt
+from blog.completion_stream import STREAM_COMPLETIONS, STREAM_MAX_ATTEMPTS, JsonBlogpostMonitor, MalformedCompletionError, YamlBlogpostMonitor, stream_chat_completion, stream_chat_completion_async
+from blog.structured_output import BLOGPOST_RESPONSE_FORMAT, JSON_RESPONSE_INSTRUCTION, parse_json_response, use_json_schema
+from rate_limiting.rate_limiter import call_with_rate_limit, call_with_rate_limit_async
 from enums.blogpost_subject import BlogPostSubject
 
 # Configure logging
@@ -28,16 +38,54 @@ load_dotenv("config/environment_variables.env")
 
 # Load API key from environment variable
 api_key = os.getenv("OPENAI_API_KEY")
-
-# Ensure API key is set
-if api_key is None:
-    raise ValueError("Error: OPENAI_API_KEY is not set in the environment variables.")
-
-# Initialize OpenAI client
-client = openai.OpenAI(api_key=api_key)
+# Set OPENAI_BASE_URL to send the requests somewhere else, e.g. to benchmarks/openai_stand_in.py
+base_url = os.getenv("OPENAI_BASE_URL") or None
+
+# OpenAI clients are created on first use, so this module can be imported without an API key.
+# The async one is used when several subjects are generated at the same time. They do not retry
+# themselves: call_openai retries through the rate limiter, which also paces the retries.
+client = None
+async_client = None
+client_lock = threading.Lock()
+
+def get_api_key() -> str:
+    """Returns the OpenAI API key, or raises if it is not set."""
+    if api_key is None:
+        raise ValueError("Error: OPENAI_API_KEY is not set in the environment variables.")
+    return api_key
+
+def get_client() -> openai.OpenAI:
+    """Returns the shared OpenAI client, creating it on first use."""
+    global client
+    with client_lock:
+        if client is None:
+            client = openai.OpenAI(api_key=get_api_key(), base_url=base_url, max_retries=0)
+    return client
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """Returns the shared AsyncOpenAI client, creating it on first use."""
+    global async_client
+    with client_lock:
+        if async_client is None:
+            async_client = openai.AsyncOpenAI(api_key=get_api_key(), base_url=base_url, max_retries=0)
+    return async_client
+
+# Errors the SDK would have retried besides 429s: timeouts, connection errors and 5xx responses
+OPENAI_TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+def call_openai(func):
+    """Calls func() through the OpenAI rate limiter, retrying rate limits and transient errors."""
+    return call_with_rate_limit("openai", func, transient_errors=OPENAI_TRANSIENT_ERRORS)
+
+async def call_openai_async(func):
+    """call_openai for coroutine functions."""
+    return await call_with_rate_limit_async("openai", func, transient_errors=OPENAI_TRANSIENT_ERRORS)
 
 model = os.getenv("OPENAI_MODEL")
 
+# Upper bound for the generated blog post, the prompt gets the rest of the context window
+BLOGPOST_MAX_TOKENS = 1000
+
 # Custom YAML dumper to prevent quotes around dates and add quotes for special strings
 class NoQuotesForDatesDumper(yaml.SafeDumper):
     def represent_str(self, data):
@@ -74,15 +122,142 @@ def get_prompt(subject: BlogPostSubject, today) -> str:
     else:
         raise ValueError(f"Invalid prompt format for {subject.name}")
 
-def insert_emaillist_in_prompt(emails: list, prompt: str) -> str:
-    """Inserts the emails into the prompt."""
-    body = format_email_body_for_openai(emails)
-    final_prompt = prompt.format(body=body)
+def get_cached_completion(cache_key: str):
+    """Returns the cached response for cache_key, or None. Cache errors count as a miss."""
+    try:
+        cached_response = database.db_operations.get_cached_llm_response(cache_key)
+    except Exception as e:
+        logging.warning(f"Could not read the OpenAI response cache: {e}")
+        return None
+    if cached_response is None:
+        return None
+    logging.info(f"Using cached OpenAI response {cache_key[:12]}.")
+    return ChatCompletion.model_validate_json(cached_response)
+
+def is_cacheable(response: ChatCompletion, validate_response=None) -> bool:
+    """True if a response is complete (finish_reason "stop") and passes validate_response,
+    a function that returns whether the response is usable, e.g. parses into a blog post."""
+    if not response.choices or any(choice.finish_reason != "stop" for choice in response.choices):
+        return False
+    if validate_response is None:
+        return True
+    try:
+        return bool(validate_response(response))
+    except Exception as e:
+        logging.warning(f"Could not validate the OpenAI response: {e}")
+        return False
+
+def get_valid_cached_completion(cache_key: str, validate_response=None):
+    """get_cached_completion, but a cached response that does not pass is_cacheable is deleted and treated as a miss."""
+    response = get_cached_completion(cache_key)
+    if response is None or is_cacheable(response, validate_response):
+        return response
+    logging.warning(f"Cached OpenAI response {cache_key[:12]} is incomplete or unusable. Deleting it and requesting it again.")
+    try:
+        database.db_operations.delete_cached_llm_response(cache_key)
+    except Exception as e:
+        logging.warning(f"Could not delete the OpenAI response from the cache: {e}")
+    return None
+
+def cache_completion(cache_key: str, parameters: dict, response: ChatCompletion, validate_response=None):
+    """Stores a response in the cache if is_cacheable. Cache errors are logged and otherwise ignored."""
+    if not is_cacheable(response, validate_response):
+        logging.warning(f"Not caching OpenAI response {cache_key[:12]}: it is incomplete or unusable.")
+        return
+    try:
+        total_tokens = response.usage.total_tokens if response.usage else 0
+        database.db_operations.cache_llm_response(cache_key, parameters.get("model"), response.model_dump_json(), total_tokens)
+    except Exception as e:
+        logging.warning(f"Could not store the OpenAI response in the cache: {e}")
+
+def request_completion(parameters: dict, stream_monitor=None, label="Completion") -> ChatCompletion:
+    """Sends a request through the OpenAI rate limiter. With OPENAI_STREAM=true and a stream_monitor
+    (a class that checks the response while it arrives), the request is streamed and sent again
+    when the monitor finds it off-format."""
+    if not (STREAM_COMPLETIONS and stream_monitor):
+        return call_openai(lambda: get_client().chat.completions.create(**parameters))
+
+    for attempt in range(1, STREAM_MAX_ATTEMPTS + 1):
+        try:
+            return call_openai(lambda: stream_chat_completion(get_client(), parameters, stream_monitor(), label))
+        except MalformedCompletionError as e:
+            if attempt == STREAM_MAX_ATTEMPTS:
+                raise
+            logging.warning(f"{label}: aborted the response after {len(e.text)} characters ({e}). Retrying ({attempt}/{STREAM_MAX_ATTEMPTS}).")
+
+async def request_completion_async(parameters: dict, stream_monitor=None, label="Completion") -> ChatCompletion:
+    """request_completion with AsyncOpenAI."""
+    if not (STREAM_COMPLETIONS and stream_monitor):
+        return await call_openai_async(lambda: get_async_client().chat.completions.create(**parameters))
+
+    for attempt in range(1, STREAM_MAX_ATTEMPTS + 1):
+        try:
+            return await call_openai_async(lambda: stream_chat_completion_async(get_async_client(), parameters, stream_monitor(), label))
+        except MalformedCompletionError as e:
+            if attempt == STREAM_MAX_ATTEMPTS:
+                raise
+            logging.warning(f"{label}: aborted the response after {len(e.text)} characters ({e}). Retrying ({attempt}/{STREAM_MAX_ATTEMPTS}).")
+
+def create_chat_completion(stream_monitor=None, label="Completion", validate_response=None, **parameters) -> ChatCompletion:
+    """Calls the chat completions API through the response cache and request_completion.
+    A request with exactly the same parameters as a cached one gets the cached response.
+    Only complete responses that pass validate_response are cached."""
+    if not LLM_CACHE_ENABLED:
+        return request_completion(parameters, stream_monitor, label)
+
+    cache_key = make_cache_key(parameters)
+    response = get_valid_cached_completion(cache_key, validate_response)
+    if response is None:
+        response = request_completion(parameters, stream_monitor, label)
+        cache_completion(cache_key, parameters, response, validate_response)
+    return response
+
+async def create_chat_completion_async(stream_monitor=None, label="Completion", validate_response=None, **parameters) -> ChatCompletion:
+    """create_chat_completion with AsyncOpenAI. The cache is read and written in a worker thread."""
+    if not LLM_CACHE_ENABLED:
+        return await request_completion_async(parameters, stream_monitor, label)
+
+    cache_key = make_cache_key(parameters)
+    response = await asyncio.to_thread(get_valid_cached_completion, cache_key, validate_response)
+    if response is None:
+        response = await request_completion_async(parameters, stream_monitor, label)
+        await asyncio.to_thread(cache_completion, cache_key, parameters, response, validate_response)
+    return response
+
+def get_chunk_summary_prompt(subject: BlogPostSubject) -> str:
+    """Loads the prompt that summarises one chunk of emails for a subject."""
+    return Template(load_prompts()["CHUNK_SUMMARY"]).render(subject=subject.value)
+
+def summarize_chunk(chunk: str, summary_prompt: str) -> tuple:
+    """Summarises a chunk of formatted emails. Returns the summary and the tokens used."""
+    response = create_chat_completion(
+        messages=[{"role": "user", "content": summary_prompt.format(body=chunk)}],
+        model=model,
+        max_tokens=CHUNK_SUMMARY_MAX_TOKENS,
+        validate_response=lambda response: (response.choices[0].message.content or "").strip()
+    )
+    summary = response.choices[0].message.content
+    if not isinstance(summary, str) or not summary.strip():
+        raise ValueError("Chunk summary is empty.")
+    return summary.strip(), response.usage.total_tokens
+
+def insert_emaillist_in_prompt(emails: list, prompt: str, blogpost_subject: BlogPostSubject) -> tuple:
+    """Inserts the emails into the prompt, summarising them first if they do not fit the context window.
+    Returns the prompt and the tokens used for the summaries."""
+    summary_prompt = get_chunk_summary_prompt(blogpost_subject)
+    final_prompt, summary_tokens = build_prompt(
+        prompt,
+        format_email_sections(emails),
+        lambda chunk: summarize_chunk(chunk, summary_prompt),
+        summary_prompt,
+        BLOGPOST_MAX_TOKENS,
+        model
+    )
     if not final_prompt:
         raise ValueError("Prompt is empty after inserting emaillist. Please check the prompt file.")
-    return final_prompt
+    return final_prompt, summary_tokens
     
-def create_blogpost(emails: list, blogpost_subject: BlogPostSubject, today) -> BlogPostDTO:
+def create_blogpost(emails: list, blogpost_subject: BlogPostSubject, today, session=None) -> BlogPostDTO:
     """Summarizes the email body using OpenAI's GPT-3.5 model."""
     prompt = get_prompt(blogpost_subject, today)
     # Check if the emails list is empty
@@ -90,37 +265,82 @@ def create_blogpost(emails: list, blogpost_subject: BlogPostSubject, today) -> B
         raise ValueError("No emails available for processing.")
     
     
-    final_prompt = insert_emaillist_in_prompt(emails, prompt)
-    # print short version of final_prompt for debugging
-    # Check if the prompt is empty or None
-
     print(f"Preparing request for {blogpost_subject.value.capitalize()} blog post...")
     
     try:
-        response = client.chat.completions.create(
-            messages=[{"role": "user", "content": final_prompt}],
-            model=model,
-            max_tokens=1000
-        )
-        response_with_backticks = response.choices[0].message.content
-
-        if not isinstance(response_with_backticks, str):
-            raise ValueError("Response is not a valid string.")
-        
-        response_with_backticks = response_with_backticks.strip()
-        cleaned_response = response_with_backticks.strip('```yaml').strip('```')
-
-        blogpost = create_blogpost_instance_from_yaml(cleaned_response, prompt, len(emails), response.usage.total_tokens, list(set(email.sender_name for email in emails)), blogpost_subject, today)
-        
-        
-        newly_created_blogpost = database.db_operations.insert_blogpost(blogpost, generate_next_slug(today, blogpost))
-        
-        return newly_created_blogpost
+        final_prompt, summary_tokens = insert_emaillist_in_prompt(emails, prompt, blogpost_subject)
+        response = create_chat_completion(**get_blogpost_request(final_prompt, blogpost_subject))
+        return store_blogpost_from_response(response, summary_tokens, emails, prompt, blogpost_subject, today, session)
     except GeneratorExit:
         print("Generator was forcefully closed.")
     except Exception as e:
         print(f"Error in generating blogpost: {e}")
         return "Failed to generate blogpost"
+
+async def create_blogpost_async(emails: list, blogpost_subject: BlogPostSubject, today, session=None) -> BlogPostDTO:
+    """create_blogpost for the concurrent mode: the blog post request is awaited with AsyncOpenAI,
+    the prompt assembly and the database work run in worker threads."""
+    prompt = get_prompt(blogpost_subject, today)
+    if not emails:
+        raise ValueError("No emails available for processing.")
+
+    print(f"Preparing request for {blogpost_subject.value.capitalize()} blog post...")
+
+    try:
+        final_prompt, summary_tokens = await asyncio.to_thread(insert_emaillist_in_prompt, emails, prompt, blogpost_subject)
+        response = await create_chat_completion_async(**get_blogpost_request(final_prompt, blogpost_subject))
+        return await asyncio.to_thread(store_blogpost_from_response, response, summary_tokens, emails, prompt, blogpost_subject, today, session)
+    except Exception as e:
+        print(f"Error in generating blogpost: {e}")
+        return "Failed to generate blogpost"
+
+def get_blogpost_request(final_prompt: str, blogpost_subject: BlogPostSubject) -> dict:
+    """Returns the parameters of the blog post request for the configured response format."""
+    request = {
+        "messages": [{"role": "user", "content": final_prompt}],
+        "model": model,
+        "max_tokens": BLOGPOST_MAX_TOKENS,
+        "stream_monitor": YamlBlogpostMonitor,
+        "label": f"{blogpost_subject.value} blog post",
+        "validate_response": is_valid_blogpost_response,
+    }
+    if use_json_schema():
+        request["messages"].insert(0, {"role": "system", "content": JSON_RESPONSE_INSTRUCTION})
+        request["response_format"] = BLOGPOST_RESPONSE_FORMAT
+        request["stream_monitor"] = JsonBlogpostMonitor
+    return request
+
+def parse_blogpost_response(response: str):
+    """Parses a blog post response the way store_blogpost_from_response reads it: JSON in JSON mode,
+    YAML otherwise or as the fallback. Returns a dict, or None if it cannot be parsed."""
+    if use_json_schema():
+        parsed_data = parse_json_response(response)
+        if parsed_data is not None:
+            return parsed_data
+    return parse_yaml_response(response.strip().strip('```yaml').strip('```'))
+
+def is_valid_blogpost_response(response: ChatCompletion) -> bool:
+    """True if the response parses into a blog post with a description and content."""
+    content = response.choices[0].message.content
+    parsed_data = parse_blogpost_response(content) if isinstance(content, str) else None
+    return isinstance(parsed_data, dict) and all(field in parsed_data for field in ("description", "content"))
+
+def store_blogpost_from_response(response: ChatCompletion, summary_tokens: int, emails: list, prompt: str, blogpost_subject: BlogPostSubject, today, session=None) -> BlogPostDTO:
+    """Turns a JSON or YAML blog post response into a BlogPost and inserts it."""
+    response_with_backticks = response.choices[0].message.content
+
+    if not isinstance(response_with_backticks, str):
+        raise ValueError("Response is not a valid string.")
+
+    instance_arguments = (prompt, len(emails), response.usage.total_tokens + summary_tokens, list(set(email.sender_name for email in emails)), blogpost_subject, today)
+    if use_json_schema():
+        blogpost = create_blogpost_instance_from_json(response_with_backticks, *instance_arguments)
+    else:
+        response_with_backticks = response_with_backticks.strip()
+        cleaned_response = response_with_backticks.strip('```yaml').strip('```')
+        blogpost = create_blogpost_instance_from_yaml(cleaned_response, *instance_arguments)
+    
+    return database.db_operations.insert_blogpost(blogpost, generate_next_slug(today, blogpost), session=session)
     
 # Ensure the "json_data" directory exists
 DATA_DIR = os.path.join(os.getcwd(), "json_data")  # Gets the full path
@@ -128,6 +348,8 @@ os.makedirs(DATA_DIR, exist_ok=True)  # Creates the directory if it doesn't exis
 
 # Path to the JSON file
 COUNTER_FILE = os.path.join(DATA_DIR, "slug_counters.json")
+# Subjects generated at the same time share the counter file
+counter_lock = threading.Lock()
 
 def load_counters():
     """Loads the counters from a JSON file or initializes an empty dictionary."""
@@ -153,14 +375,15 @@ def save_counters(counters):
 def generate_next_slug(today, blogpost : BlogPost) -> str:
     """Generates a unique slug based on a JSON-stored counter, starting at 1 if the subject is new."""
     assert today in ["Sunday", "Wednesday"], f"Invalid day: {today}"
-    counters = load_counters()
-
     counter_key = f"{blogpost.blogpost_subject.name}-{today}"
-    # If the subject is new, initialize it at 1
-    counters[counter_key] = counters.get(counter_key, 0) + 1
+    with counter_lock:
+        counters = load_counters()
+
+        # If the subject is new, initialize it at 1
+        counters[counter_key] = counters.get(counter_key, 0) + 1
 
-    # Save updated counters
-    save_counters(counters)
+        # Save updated counters
+        save_counters(counters)
 
     slug_type = "weekly" if today == "Sunday" else "midweek"
 
@@ -171,21 +394,41 @@ def format_email_body_for_openai(emails: list) -> str:
     
     if not emails:
         return "No emails available for processing."
-    
-    structured_bodies = []
+
+    return "\n".join(format_email_sections(emails))
+
+def format_email_sections(emails: list) -> list:
+    """Structures every email for OpenAI processing, one section per email."""
+    unique_emails = []
+    seen_body_hashes = set()
 
     for email in emails:
+        # Forwarded copies and re-sends have the same body, the model only needs it once
+        body_hash = getattr(email, "body_hash", None) or hash_body(email.body)
+        if body_hash in seen_body_hashes:
+            logging.info(f"Skipping email '{email.subject}' from {email.sender_name}: same body as an earlier email.")
+            continue
+        seen_body_hashes.add(body_hash)
+        unique_emails.append(email)
+
+    # Stories and footers that another email already carries are left out, the emails themselves are not changed
+    structured_bodies = []
+    for email, body in zip(unique_emails, deduplicate_stories(unique_emails)):
+        if not body.strip():
+            logging.info(f"Skipping email '{email.subject}' from {email.sender_name}: all of its content is covered by other emails.")
+            continue
+
         structured_body = (
             f"Newsletter: {email.sender_name}\n"
             f"Email: {email.sender_email}\n"
             f"Subject: {email.subject}\n"
             f"Date: {email.date}\n\n"
-            f"Content:\n{email.body}\n\n"
+            f"Content:\n{body}\n\n"
             f"{'-' * 30}"
         )
         structured_bodies.append(structured_body)
 
-    return "\n".join(structured_bodies)
+    return structured_bodies
 
 def parse_yaml_response(response: str):
     """Parses an OpenAI YAML response and ensures it's valid."""
@@ -227,6 +470,21 @@ def create_blogpost_instance_from_yaml(response: str, prompt: str, amount_of_ema
     print(f"Newsletter Sources: {newsletter_sources}")
     print(f"Blogpost Subject: {blogpost_subject}")
     parsed_data = parse_yaml_response(response)
+    return create_blogpost_instance(parsed_data, prompt, amount_of_emails, amount_of_tokens, newsletter_sources, blogpost_subject, today)
+
+def create_blogpost_instance_from_json(response: str, prompt: str, amount_of_emails: int, amount_of_tokens: int, newsletter_sources: list, blogpost_subject: BlogPostSubject, today) -> BlogPost:
+    """Creates a BlogPost instance from a structured-output JSON response, or from YAML if the response is not valid JSON."""
+    parsed_data = parse_json_response(response)
+    if parsed_data is None:
+        logging.warning("Response is not valid blog post JSON. Trying to read it as YAML.")
+        cleaned_response = response.strip().strip('```yaml').strip('```')
+        return create_blogpost_instance_from_yaml(cleaned_response, prompt, amount_of_emails, amount_of_tokens, newsletter_sources, blogpost_subject, today)
+    return create_blogpost_instance(parsed_data, prompt, amount_of_emails, amount_of_tokens, newsletter_sources, blogpost_subject, today)
+
+def create_blogpost_instance(parsed_data: dict, prompt: str, amount_of_emails: int, amount_of_tokens: int, newsletter_sources: list, blogpost_subject: BlogPostSubject, today) -> BlogPost:
+    """Creates a BlogPost instance from the parsed fields of a response."""
+    if parsed_data is None:
+        raise ValueError("Response could not be parsed.")
 
     # Validate required fields
     required_fields = ["description", "content"]
@@ -236,8 +494,8 @@ def create_blogpost_instance_from_yaml(response: str, prompt: str, amount_of_ema
     
     
     
-    print("🔍 Parsed YAML Response:")
-    print(json.dumps(parsed_data, indent=2))  # Pretty-print parsed YAML
+    print("🔍 Parsed Response:")
+    print(json.dumps(parsed_data, indent=2))  # Pretty-print parsed response
     
     metadata = BlogPostMetadata(
         title=create_title(blogpost_subject, today),
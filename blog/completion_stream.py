@@ -0,0 +1,187 @@
+import logging
+import os
+import re
+import time
+from dotenv import load_dotenv
+from openai.types.chat import ChatCompletion
+from blog.structured_output import parse_json_response
+
+load_dotenv("config/environment_variables.env")
+
+# With OPENAI_STREAM=true the blog post request is streamed. Its structure is checked while it arrives,
+# so an answer that is clearly not the requested JSON or YAML is aborted after a few lines instead of being
+# paid for in full, and requested again up to OPENAI_STREAM_MAX_ATTEMPTS times.
+STREAM_COMPLETIONS = os.getenv("OPENAI_STREAM", "false").lower() in ("1", "true", "yes")
+STREAM_MAX_ATTEMPTS = int(os.getenv("OPENAI_STREAM_MAX_ATTEMPTS", "3"))
+
+class MalformedCompletionError(ValueError):
+    """A streamed completion that is not in the requested format."""
+
+    def __init__(self, message, text=""):
+        super().__init__(message)
+        self.text = text
+
+class YamlBlogpostMonitor:
+    """Checks the YAML structure of a blog post response line by line as it is streamed.
+
+    The first line that is not blank or a code fence must be a top-level key, description and
+    content must both be present at the end, and content must start within the first
+    MAX_CHARACTERS_BEFORE_CONTENT characters (description and tags are short).
+    """
+
+    REQUIRED_KEYS = ("description", "content")
+    MAX_CHARACTERS_BEFORE_CONTENT = 4000
+    TOP_LEVEL_KEY_REGEX = re.compile(r'^([A-Za-z_][\w-]*)\s*:')
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.started = False
+        self.keys = set()
+
+    def feed(self, delta):
+        """Adds streamed text and checks every line that is now complete."""
+        self.text += delta
+        while True:
+            end = self.text.find("\n", self.position)
+            if end < 0:
+                break
+            self.check_line(self.text[self.position:end])
+            self.position = end + 1
+        if "content" not in self.keys and len(self.text) > self.MAX_CHARACTERS_BEFORE_CONTENT:
+            raise MalformedCompletionError(f"No content key in the first {self.MAX_CHARACTERS_BEFORE_CONTENT} characters", self.text)
+
+    def check_line(self, line):
+        stripped = line.strip()
+        if not self.started:
+            if not stripped or stripped.startswith("```"):
+                return
+            self.started = True
+            if not self.TOP_LEVEL_KEY_REGEX.match(line):
+                raise MalformedCompletionError(f"Response does not start with a YAML key: {stripped[:80]!r}", self.text)
+        match = self.TOP_LEVEL_KEY_REGEX.match(line)
+        if match:
+            self.keys.add(match.group(1))
+
+    def finish(self):
+        """Checks the last line and that every required key was present."""
+        self.check_line(self.text[self.position:])
+        self.position = len(self.text)
+        missing_keys = [key for key in self.REQUIRED_KEYS if key not in self.keys]
+        if missing_keys:
+            raise MalformedCompletionError(f"Response is missing {', '.join(missing_keys)}", self.text)
+
+class JsonBlogpostMonitor:
+    """Checks a structured-output blog post while it is streamed: it must be a JSON object with
+    content starting within MAX_CHARACTERS_BEFORE_CONTENT characters, and decode at the end."""
+
+    MAX_CHARACTERS_BEFORE_CONTENT = YamlBlogpostMonitor.MAX_CHARACTERS_BEFORE_CONTENT
+
+    def __init__(self):
+        self.text = ""
+        self.started = False
+        self.has_content = False
+
+    def feed(self, delta):
+        """Adds streamed text and checks what can be checked so far."""
+        self.text += delta
+        if not self.started and self.text.strip():
+            self.started = True
+            if not self.text.lstrip().startswith("{"):
+                raise MalformedCompletionError(f"Response is not a JSON object: {self.text.strip()[:80]!r}", self.text)
+        if not self.has_content:
+            self.has_content = '"content"' in self.text
+            if not self.has_content and len(self.text) > self.MAX_CHARACTERS_BEFORE_CONTENT:
+                raise MalformedCompletionError(f"No content field in the first {self.MAX_CHARACTERS_BEFORE_CONTENT} characters", self.text)
+
+    def finish(self):
+        """Checks that the complete response decodes into a blog post."""
+        if parse_json_response(self.text) is None:
+            raise MalformedCompletionError("Response is not a valid blog post JSON object", self.text)
+
+class CompletionStream:
+    """Collects the chunks of a streamed chat completion into a ChatCompletion and measures its speed."""
+
+    def __init__(self, monitor=None):
+        self.monitor = monitor
+        self.parts = []
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+        self.id = None
+        self.model = None
+        self.created = None
+        self.finish_reason = None
+        self.usage = None
+        self.chunk_count = 0
+
+    def add(self, chunk):
+        """Adds one ChatCompletionChunk, the last one only carries the usage."""
+        self.id, self.model, self.created = chunk.id, chunk.model, chunk.created
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        for choice in chunk.choices:
+            if choice.delta.content:
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                self.parts.append(choice.delta.content)
+                self.chunk_count += 1
+                if self.monitor is not None:
+                    self.monitor.feed(choice.delta.content)
+            if choice.finish_reason:
+                self.finish_reason = choice.finish_reason
+
+    def finish(self):
+        """Returns the complete response as the ChatCompletion a non-streamed request would have returned."""
+        self.finished_at = time.perf_counter()
+        if self.monitor is not None:
+            self.monitor.finish()
+        return ChatCompletion.model_validate({
+            "id": self.id or "",
+            "object": "chat.completion",
+            "created": self.created or int(time.time()),
+            "model": self.model or "",
+            "choices": [{
+                "index": 0,
+                "finish_reason": self.finish_reason or "stop",
+                "message": {"role": "assistant", "content": "".join(self.parts)},
+            }],
+            "usage": self.usage.model_dump() if self.usage is not None else None,
+        })
+
+    def log_metrics(self, label):
+        """Logs the time to first token and the generation speed."""
+        time_to_first_token = (self.first_token_at or self.finished_at) - self.started_at
+        generation_seconds = self.finished_at - (self.first_token_at or self.finished_at)
+        # Without usage in the stream, every content chunk is counted as a token
+        completion_tokens = self.usage.completion_tokens if self.usage is not None else self.chunk_count
+        tokens_per_second = completion_tokens / generation_seconds if generation_seconds > 0 else 0.0
+        logging.info(
+            f"{label}: first token after {time_to_first_token:.2f}s, {completion_tokens} tokens in "
+            f"{generation_seconds:.2f}s ({tokens_per_second:.1f} tokens/s)"
+        )
+
+def stream_parameters(parameters):
+    """Returns the request parameters with streaming and the final usage chunk switched on."""
+    return {**parameters, "stream": True, "stream_options": {"include_usage": True}}
+
+def stream_chat_completion(client, parameters, monitor=None, label="Completion"):
+    """Streams a chat completion and returns it as a ChatCompletion. The connection is closed
+    as soon as the monitor raises MalformedCompletionError."""
+    accumulator = CompletionStream(monitor)
+    with client.chat.completions.create(**stream_parameters(parameters)) as stream:
+        for chunk in stream:
+            accumulator.add(chunk)
+    completion = accumulator.finish()
+    accumulator.log_metrics(label)
+    return completion
+
+async def stream_chat_completion_async(async_client, parameters, monitor=None, label="Completion"):
+    """stream_chat_completion for AsyncOpenAI."""
+    accumulator = CompletionStream(monitor)
+    async with await async_client.chat.completions.create(**stream_parameters(parameters)) as stream:
+        async for chunk in stream:
+            accumulator.add(chunk)
+    completion = accumulator.finish()
+    accumulator.log_metrics(label)
+    return completion
@@ -0,0 +1,124 @@
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from dotenv import load_dotenv
+
+try:
+    import tiktoken  # In requirements.txt; without it token counts are estimated from the text length
+except ImportError:
+    tiktoken = None
+
+load_dotenv("config/environment_variables.env")
+
+# A prompt that does not fit the context window is built in map-reduce fashion: the email sections are
+# packed into chunks that fit, every chunk is summarised in parallel (map) and the summaries take the
+# place of the emails in the prompt (reduce). Summaries of summaries are made until the prompt fits.
+MODEL_CONTEXT_TOKENS = int(os.getenv("OPENAI_CONTEXT_TOKENS", "128000"))
+MAP_CHUNK_TOKENS = int(os.getenv("PROMPT_MAP_CHUNK_TOKENS", "24000"))
+MAP_WORKERS = int(os.getenv("PROMPT_MAP_WORKERS", "4"))
+CHUNK_SUMMARY_MAX_TOKENS = int(os.getenv("CHUNK_SUMMARY_MAX_TOKENS", "1500"))
+MAX_REDUCE_ROUNDS = 3
+# Headroom for the chat message framing and for the estimate when tiktoken is not installed
+PROMPT_SAFETY_TOKENS = 1000
+# The estimate errs on the high side: HTML, URLs and non-English text have fewer than 4 characters per token
+CHARACTERS_PER_TOKEN = 3
+ESTIMATE_MARGIN = 1.15
+FALLBACK_ENCODING = "o200k_base"
+
+@lru_cache(maxsize=None)
+def warn_estimated_token_counts(reason):
+    """Logs once that token counts are estimated."""
+    logging.warning(f"{reason}: token counts are estimated from the text length.")
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding of a model, or None when tiktoken or the encoding is not available."""
+    if tiktoken is None:
+        warn_estimated_token_counts("tiktoken is not installed (pip install -r requirements.txt)")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model or "")
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        # The encoding is downloaded on first use, set TIKTOKEN_CACHE_DIR to keep it between runs
+        warn_estimated_token_counts(f"Could not load the tiktoken encoding ({type(e).__name__})")
+        return None
+
+def count_tokens(text, model=None):
+    """Counts the tokens of text for the model, or estimates them without tiktoken."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARACTERS_PER_TOKEN * ESTIMATE_MARGIN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, limit, model=None):
+    """Cuts text down to at most limit tokens."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:int(limit * CHARACTERS_PER_TOKEN / ESTIMATE_MARGIN)]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:limit])
+
+def get_input_budget(max_tokens):
+    """Returns how many prompt tokens fit next to a completion of max_tokens."""
+    return MODEL_CONTEXT_TOKENS - max_tokens - PROMPT_SAFETY_TOKENS
+
+def pack_into_chunks(sections, chunk_tokens, model=None):
+    """Packs sections in order into as few chunks of at most chunk_tokens as possible.
+    A section that is larger than a chunk on its own is truncated."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for section in sections:
+        section_tokens = count_tokens(section, model)
+        if section_tokens > chunk_tokens:
+            logging.warning(f"Truncating a section of {section_tokens} tokens to the chunk size of {chunk_tokens} tokens.")
+            section = truncate_to_tokens(section, chunk_tokens, model)
+            section_tokens = chunk_tokens
+        if current and current_tokens + section_tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(section)
+        current_tokens += section_tokens + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def build_prompt(prompt, sections, summarize, summary_prompt, max_tokens, model=None):
+    """Inserts the sections into prompt as {body}, summarising them first if they do not fit.
+
+    summarize(chunk) returns (summary, tokens used) for a chunk of sections, with summary_prompt
+    being the template it puts the chunk in. Returns the final prompt and the tokens the summaries used.
+    """
+    body_budget = get_input_budget(max_tokens) - count_tokens(prompt.replace("{body}", ""), model)
+    chunk_tokens = min(MAP_CHUNK_TOKENS, get_input_budget(CHUNK_SUMMARY_MAX_TOKENS) - count_tokens(summary_prompt, model))
+    if body_budget <= 0 or chunk_tokens <= CHUNK_SUMMARY_MAX_TOKENS:
+        raise ValueError(f"The prompt templates leave no room for emails in a context window of {MODEL_CONTEXT_TOKENS} tokens.")
+
+    body = "\n".join(sections)
+    body_tokens = count_tokens(body, model)
+    tokens_used = 0
+    for reduce_round in range(1, MAX_REDUCE_ROUNDS + 1):
+        if body_tokens <= body_budget:
+            break
+        chunks = pack_into_chunks(sections, chunk_tokens, model)
+        logging.info(f"Prompt body of {body_tokens} tokens exceeds the budget of {body_budget}. Summarising {len(chunks)} chunks (round {reduce_round}).")
+        with ThreadPoolExecutor(max_workers=MAP_WORKERS) as executor:
+            results = list(executor.map(summarize, chunks))
+        sections = [summary for summary, _ in results]
+        tokens_used += sum(tokens for _, tokens in results)
+
+        previous_tokens = body_tokens
+        body = "\n".join(sections)
+        body_tokens = count_tokens(body, model)
+        if body_tokens >= previous_tokens:
+            raise ValueError(f"Summarising did not shrink the prompt body ({previous_tokens} -> {body_tokens} tokens).")
+    else:
+        if body_tokens > body_budget:
+            raise ValueError(f"Prompt body still has {body_tokens} tokens after {MAX_REDUCE_ROUNDS} rounds of summaries, the budget is {body_budget}.")
+
+    return prompt.format(body=body), tokens_used
@@ -0,0 +1,155 @@
+import logging
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from dotenv import load_dotenv
+
+load_dotenv("config/environment_variables.env")
+
+# Newsletters cover the same story in the same week and repeat their own footers in every issue.
+# Bodies are split into paragraph-sized chunks, compared with TF-IDF cosine similarity, and a chunk is
+# dropped when a longer chunk from another email is similar to it and contains almost all of its
+# weighted terms. Rewritten coverage of a story shares fewer terms and is kept, so distinct news is
+# never lost for the sake of tokens.
+STORY_DEDUPLICATION = os.getenv("STORY_DEDUPLICATION", "true").lower() in ("1", "true", "yes")
+STORY_SIMILARITY_THRESHOLD = float(os.getenv("STORY_SIMILARITY_THRESHOLD", "0.5"))
+STORY_COVERAGE_THRESHOLD = float(os.getenv("STORY_COVERAGE_THRESHOLD", "0.8"))
+CHUNK_MIN_WORDS = 25
+CHUNK_MAX_WORDS = 160
+
+CHUNK_END_REGEX = re.compile(r'[.!?"”’)\]]\s*$')
+TOKEN_REGEX = re.compile(r"[a-z0-9][a-z0-9'’.-]*[a-z0-9]|[a-z0-9]")
+STOP_WORDS = set(
+    "the a an and or of to in on for with is are was were be been by as at from that this it its their they "
+    "we you your our has have had not but will can into about more than after over new just also which who "
+    "what how said says".split()
+)
+
+def split_into_chunks(body: str) -> list:
+    """Splits a body into paragraph-sized chunks that end on a sentence boundary where possible."""
+    chunks = []
+    lines = []
+    word_count = 0
+    for line in body.split("\n"):
+        if not line.strip():
+            continue
+        lines.append(line)
+        word_count += len(line.split())
+        if (word_count >= CHUNK_MIN_WORDS and CHUNK_END_REGEX.search(line)) or word_count >= CHUNK_MAX_WORDS:
+            chunks.append("\n".join(lines))
+            lines = []
+            word_count = 0
+    if lines:
+        chunks.append("\n".join(lines))
+    return chunks
+
+def tokenize(chunk: str) -> list:
+    """Returns the lowercase content words of a chunk."""
+    return [token for token in TOKEN_REGEX.findall(chunk.lower()) if len(token) > 1 and token not in STOP_WORDS]
+
+def build_term_weights(token_lists: list):
+    """Returns the TF-IDF weights of the terms every chunk shares with another chunk, as one sparse
+    {term: weight} dict per chunk, plus the full vector norm and total weight of every chunk.
+    Terms in a single chunk only matter for those two."""
+    counts = [Counter(tokens) for tokens in token_lists]
+    document_frequency = Counter(term for chunk_counts in counts for term in chunk_counts)
+    chunk_total = len(counts)
+
+    weights, norms, totals = [], [], []
+    for chunk_counts in counts:
+        shared_weights = {}
+        norm = total = 0.0
+        for term, count in chunk_counts.items():
+            weight = (1 + math.log(count)) * (math.log((1 + chunk_total) / (1 + document_frequency[term])) + 1)
+            norm += weight * weight
+            total += weight
+            if document_frequency[term] > 1:
+                shared_weights[term] = weight
+        weights.append(shared_weights)
+        norms.append(math.sqrt(norm))
+        totals.append(total)
+    return weights, norms, totals
+
+def get_candidate_terms(shared_weights: dict, total: float) -> list:
+    """Returns the heaviest shared terms of a chunk that any chunk covering STORY_COVERAGE_THRESHOLD
+    of its weight must contain at least one of. Empty if no chunk can cover that much."""
+    shared_total = sum(shared_weights.values())
+    # Without these terms another chunk covers at most shared_total - their weight
+    needed = shared_total - STORY_COVERAGE_THRESHOLD * total
+    if needed < 0:
+        return []
+    candidate_terms = []
+    for term, weight in sorted(shared_weights.items(), key=lambda item: -item[1]):
+        candidate_terms.append(term)
+        needed -= weight
+        if needed < 0:
+            break
+    return candidate_terms
+
+def find_duplicate_chunks(chunks: list) -> dict:
+    """Takes (email_index, text) chunks and returns {duplicate chunk: representative chunk}, by position.
+
+    Chunks are visited longest first. A chunk is a duplicate of the first kept chunk from another
+    email that is similar enough and covers enough of its weighted terms. Only kept chunks that contain
+    one of its candidate terms can qualify, so they are found through an inverted index of the kept
+    chunks instead of comparing every pair.
+    """
+    token_lists = [tokenize(text) for _, text in chunks]
+    weights, norms, totals = build_term_weights(token_lists)
+
+    duplicates = {}
+    kept_rank = {}  # kept chunk -> order in which it was kept
+    kept_by_term = defaultdict(list)
+    for position in sorted(range(len(chunks)), key=lambda i: (-len(chunks[i][1]), i)):
+        shared_weights = weights[position]
+        candidates = {
+            candidate
+            for term in get_candidate_terms(shared_weights, totals[position])
+            for candidate in kept_by_term[term]
+            if chunks[candidate][0] != chunks[position][0]
+        } if token_lists[position] else set()
+
+        for candidate in sorted(candidates, key=kept_rank.get):
+            candidate_weights = weights[candidate]
+            common_terms = shared_weights.keys() & candidate_weights.keys()
+            similarity = sum(shared_weights[term] * candidate_weights[term] for term in common_terms) / ((norms[position] * norms[candidate]) or 1)
+            # Share of the weight of this chunk carried by terms that also occur in the candidate
+            coverage = sum(shared_weights[term] for term in common_terms) / (totals[position] or 1)
+            if similarity >= STORY_SIMILARITY_THRESHOLD and coverage >= STORY_COVERAGE_THRESHOLD:
+                duplicates[position] = candidate
+                break
+        else:
+            kept_rank[position] = len(kept_rank)
+            for term in shared_weights:
+                kept_by_term[term].append(position)
+    return duplicates
+
+def deduplicate_stories(emails: list) -> list:
+    """Returns the body of every email with the chunks already covered by another email removed,
+    in the order of emails. A body can come back empty when all of it was covered elsewhere."""
+    bodies = [email.body or "" for email in emails]
+    if not STORY_DEDUPLICATION or len(emails) < 2:
+        return bodies
+
+    email_chunks = [split_into_chunks(body) for body in bodies]
+    chunks = [(email_index, text) for email_index, texts in enumerate(email_chunks) for text in texts]
+    if not chunks:
+        return bodies
+    duplicates = find_duplicate_chunks(chunks)
+    if not duplicates:
+        return bodies
+
+    deduplicated_bodies = []
+    position = 0
+    for texts in email_chunks:
+        kept_texts = [text for offset, text in enumerate(texts) if position + offset not in duplicates]
+        deduplicated_bodies.append("\n\n".join(kept_texts))
+        position += len(texts)
+
+    removed_characters = sum(len(chunks[duplicate][1]) for duplicate in duplicates)
+    logging.info(
+        f"Story deduplication removed {len(duplicates)} of {len(chunks)} chunks "
+        f"({removed_characters} of {sum(len(text) for _, text in chunks)} characters) already covered by another email."
+    )
+    return deduplicated_bodies
@@ -0,0 +1,59 @@
+import logging
+import os
+import jiter
+from dotenv import load_dotenv
+
+load_dotenv("config/environment_variables.env")
+
+# Blog posts are requested as JSON that has to match BLOGPOST_JSON_SCHEMA (OpenAI structured outputs),
+# so the answer can be decoded directly instead of cleaning up and parsing free-form YAML.
+# Set OPENAI_RESPONSE_FORMAT=yaml for models without structured outputs.
+RESPONSE_FORMAT = os.getenv("OPENAI_RESPONSE_FORMAT", "json_schema").lower()
+
+BLOGPOST_JSON_SCHEMA = {
+    "name": "blogpost",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "description": {"type": "string"},
+            "tags": {"type": "array", "items": {"type": "string"}},
+            "content": {"type": "string"},
+        },
+        "required": ["description", "tags", "content"],
+        "additionalProperties": False,
+    },
+}
+BLOGPOST_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": BLOGPOST_JSON_SCHEMA}
+# The prompts describe the fields in YAML, this tells the model to send them as JSON instead
+JSON_RESPONSE_INSTRUCTION = (
+    "Return the blog post as a JSON object with the fields description, tags and content, "
+    "following the response format in the prompt. content holds the HTML of the post."
+)
+
+def use_json_schema():
+    """True if blog posts are requested as schema-constrained JSON."""
+    return RESPONSE_FORMAT == "json_schema"
+
+def parse_json_response(response: str):
+    """Decodes a JSON blog post response and checks the field types. Returns a dict, or None if it is not valid."""
+    text = response.strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        parsed_data = jiter.from_json(text.encode("utf-8"))
+    except ValueError as e:
+        logging.error(f"Error parsing JSON response: {e}")
+        return None
+
+    if not isinstance(parsed_data, dict):
+        logging.error(f"Parsed JSON is not an object: {str(parsed_data)[:200]}")
+        return None
+    if not isinstance(parsed_data.get("description"), str) or not isinstance(parsed_data.get("content"), str):
+        logging.error("JSON response has no description or content string.")
+        return None
+    tags = parsed_data.get("tags") or []
+    if not isinstance(tags, list):
+        tags = [tags]
+    parsed_data["tags"] = [str(tag) for tag in tags]
+    return parsed_data
@@ -0,0 +1,50 @@
+import hashlib
+import re
+import unicodedata
+from entities.Email_body import EmailBody
+
+# Email bodies are stored once per distinct content in email_bodies, keyed by the hash of the
+# normalised body. Bodies that only differ in whitespace or line endings share one row.
+
+HORIZONTAL_WHITESPACE_REGEX = re.compile(r'[ \t\f\v\u00a0]+')
+BLANK_LINES_REGEX = re.compile(r'\n{2,}')
+
+def normalize_body(body):
+    """Normalises a body for hashing: NFC, unified line endings, collapsed spaces and blank lines."""
+    body = unicodedata.normalize("NFC", body).replace("\r\n", "\n").replace("\r", "\n")
+    body = "\n".join(HORIZONTAL_WHITESPACE_REGEX.sub(" ", line).strip() for line in body.split("\n"))
+    return BLANK_LINES_REGEX.sub("\n", body).strip()
+
+def hash_body(body):
+    """Returns the hex sha256 of the normalised body."""
+    return hashlib.sha256(normalize_body(body).encode("utf-8")).hexdigest()
+
+def store_email_bodies(session, emails):
+    """Points every email at the shared body row for its content, creating rows for new content.
+
+    Looks up all hashes of the batch with one query. Returns the number of emails whose body was
+    already stored, which are also counted in EmailBody.duplicate_hits.
+    """
+    bodies_by_hash = {}
+    hashes = {}
+    for email in emails:
+        hashes[id(email)] = hash_body(email.body)
+    if not hashes:
+        return 0
+
+    for stored_body in session.query(EmailBody).filter(EmailBody.body_hash.in_(set(hashes.values()))):
+        bodies_by_hash[stored_body.body_hash] = stored_body
+
+    duplicates = 0
+    for email in emails:
+        body_hash = hashes[id(email)]
+        stored_body = bodies_by_hash.get(body_hash)
+        if stored_body is None:
+            stored_body = EmailBody(body_hash=body_hash, body=email.body, size=len(email.body), duplicate_hits=0)
+            session.add(stored_body)
+            bodies_by_hash[body_hash] = stored_body
+        else:
+            stored_body.duplicate_hits += 1
+            duplicates += 1
+        email.use_stored_body(stored_body)
+    return duplicates
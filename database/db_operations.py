@@ -1,11 +1,12 @@
 from contextlib import contextmanager
 import json
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, and_, or_
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base, joinedload, object_session
 from sqlalchemy.exc import SQLAlchemyError
 from dotenv import load_dotenv
 from enums.blogpost_status import BlogPostStatus
+from enums.blogpost_subject import BlogPostSubject
 from enums.gmail_labels import GmailLabels
 from enums.newsletters import Newsletters
 from datetime import datetime
@@ -13,41 +14,77 @@ import re
 from entities.Email import Email
 from entities.Blogpost import BlogPost
 from entities.Blogpost_metadata import BlogPostMetadata
+from entities.Mailbox_sync_state import MailboxSyncState
+from entities.Openai_batch_job import OpenAIBatchJob
 from entities.BlogpostDTO import BlogPostDTO, BlogPostMetadataDTO
 import logging
 from database.base import Base
-
-# Enable logging
-logging.basicConfig()
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)  # Show SQL queries
-logging.getLogger('sqlalchemy').setLevel(logging.DEBUG)  # Show additional debug info
+from database.engine import close_database_engine, create_database_engine
+from database.migrations import run_migrations
+from database import search_index
+from database.body_store import store_email_bodies
+from database import response_cache
 
 load_dotenv("config/environment_variables.env")
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL, echo=True)
+# SQL statements are only logged with DATABASE_ECHO=true
+engine = create_database_engine(DATABASE_URL)
 Session = sessionmaker(bind=engine, expire_on_commit=False)
 
 @contextmanager
 def get_session():
-    """Context manager for SQLAlchemy session."""
+    """Context manager for SQLAlchemy session. Commits on success, rolls back and re-raises on error."""
     session = Session()
     try:
         yield session
         session.commit()
     except SQLAlchemyError as e:
         session.rollback()
-        print(f"Error: {e}")
+        logging.error(f"Database error, transaction rolled back: {e}")
+        raise
     finally:
         session.close()
 
+@contextmanager
+def unit_of_work():
+    """Opens a session whose changes are committed together when the block ends.
+
+    Pass the session to the functions below to run them inside it: they then only flush
+    their changes, and the whole unit is committed once, or rolled back on any exception.
+    """
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+@contextmanager
+def session_scope(session=None):
+    """Uses the given unit-of-work session and flushes at the end, or opens a session of its own."""
+    if session is None:
+        with get_session() as own_session:
+            yield own_session
+    else:
+        yield session
+        session.flush()
+
 def initialize_database():
     """Initialize the database with the required tables."""
     try:
         # Print the names of the tables to see if the table exists in metadata
         Base.metadata.create_all(engine)  # Create all tables
         print("Tables created successfully.")
+
+        # Bring existing databases up to date with the current schema
+        applied_versions = run_migrations(engine)
+        if applied_versions:
+            print(f"Applied schema migrations: {applied_versions}")
         
         # Check again to confirm
         print("Tables after creation:", Base.metadata.tables.keys())
@@ -55,47 +92,213 @@ def initialize_database():
     except SQLAlchemyError as e:
         print(f"Error creating database tables: {e}")
 
-def insert_email(email):
+def close_database():
+    """Closes the database connections at the end of a run."""
+    close_database_engine(engine)
+
+def insert_email(email, session=None):
     """Insert a new email into the emails table and return the created email."""
 
     if isinstance(email.date, str):
         email.date = convert_date(email.date)
 
-    with get_session() as session:
+    with session_scope(session) as session:
+        store_email_bodies(session, [email])
         session.add(email)
-        session.commit()
-        session.refresh(email)
+        session.flush()
+        search_index.index_emails(session, [email])
     return email
 
-def update_email_published_status(email_id, published):
+def ingest_emails(emails, chunk_size=500, session=None):
+    """Insert the emails whose Gmail ID is not stored yet, all in one transaction.
+
+    Stored Gmail IDs are looked up with one IN query per chunk_size emails, and an email that appears
+    twice in emails is inserted once. Bodies go to the shared email_bodies store.
+    Returns the number of inserted and skipped emails and of inserted emails whose body was already stored.
+    """
+    new_emails = {}
+    skipped = 0
+    inserted = 0
+    duplicate_bodies = 0
+    with session_scope(session) as session:
+        for start in range(0, len(emails), chunk_size):
+            chunk = emails[start:start + chunk_size]
+            stored_gmail_ids = {
+                gmail_id for (gmail_id,) in
+                session.query(Email.gmail_id).filter(Email.gmail_id.in_([email.gmail_id for email in chunk]))
+            }
+            for email in chunk:
+                if email.gmail_id in stored_gmail_ids or email.gmail_id in new_emails:
+                    skipped += 1
+                    continue
+                if isinstance(email.date, str):
+                    email.date = convert_date(email.date)
+                new_emails[email.gmail_id] = email
+        duplicate_bodies = store_email_bodies(session, list(new_emails.values()))
+        session.add_all(new_emails.values())
+        session.flush()
+        search_index.index_emails(session, new_emails.values())
+        inserted = len(new_emails)
+    return inserted, skipped, duplicate_bodies
+
+def update_email_published_status(email_id, published, session=None):
     """Update the published status of an email and return the updated email."""
-    with get_session() as session:
+    with session_scope(session) as session:
         email = session.query(Email).filter(Email.id == email_id).first()
         if email:
             email.published = published
-            session.commit()
-            session.refresh(email)
     return email
 
-def get_all_emails():
-    """Get all emails from the emails table."""
-    with get_session() as session:
+def mark_emails_published(gmail_ids, chunk_size=500, session=None):
+    """Set the published flag of the emails with the given Gmail IDs, one UPDATE per chunk_size IDs."""
+    gmail_ids = list(gmail_ids)
+    with session_scope(session) as session:
+        for start in range(0, len(gmail_ids), chunk_size):
+            session.query(Email).filter(Email.gmail_id.in_(gmail_ids[start:start + chunk_size])).update({Email.published: 1}, synchronize_session=False)
+
+def get_published_gmail_ids(gmail_ids, chunk_size=500, session=None):
+    """Return the Gmail IDs among gmail_ids whose email is already in a pushed blog post."""
+    gmail_ids = list(gmail_ids)
+    published = set()
+    with session_scope(session) as session:
+        for start in range(0, len(gmail_ids), chunk_size):
+            published.update(
+                gmail_id for (gmail_id,) in
+                session.query(Email.gmail_id).filter(Email.gmail_id.in_(gmail_ids[start:start + chunk_size]), Email.published == 1)
+            )
+    return published
+
+def get_all_emails(session=None):
+    """Get all emails from the emails table. Use iter_emails to walk a large archive."""
+    with session_scope(session) as session:
         emails = session.query(Email).all()
     return emails
 
-def get_email_by_id(email_id):
+def iter_emails(batch_size=500, columns=None, since=None, until=None, sender_email=None, published=None):
+    """Yield the stored emails in (date, id) order, reading batch_size rows per query.
+
+    Each batch continues after the (date, id) of the previous one instead of using OFFSET, so every
+    query is an index range scan and memory stays at one batch however large the archive is.
+    With columns (e.g. ["id", "date", "subject"]) only those columns are read and rows are yielded
+    instead of Email objects, which leaves out the body. since/until bound the date (until exclusive).
+    """
+    selected = [getattr(Email, name) for name in columns] if columns else [Email]
+    if columns:
+        selected += [column for column in (Email.date, Email.id) if column.key not in columns]  # Needed for the keyset
+
+    filters = []
+    if since is not None:
+        filters.append(Email.date >= since)
+    if until is not None:
+        filters.append(Email.date < until)
+    if sender_email is not None:
+        filters.append(Email.sender_email == sender_email)
+    if published is not None:
+        filters.append(Email.published == int(published))
+
+    last_date = last_id = None
+    while True:
+        with get_session() as session:
+            query = session.query(*selected).filter(*filters)
+            if last_id is not None:
+                query = query.filter(or_(Email.date > last_date, and_(Email.date == last_date, Email.id > last_id)))
+            batch = query.order_by(Email.date, Email.id).limit(batch_size).all()
+        if not batch:
+            return
+        last_date, last_id = batch[-1].date, batch[-1].id
+        if columns:
+            yield from (tuple(getattr(row, name) for name in columns) for row in batch)
+        else:
+            yield from batch
+        if len(batch) < batch_size:
+            return
+
+def get_email_by_id(email_id, session=None):
     """Get an email by its unique ID."""
-    with get_session() as session:
+    with session_scope(session) as session:
         email = session.query(Email).filter(Email.id == email_id).first()
     return email
 
-def check_if_email_exists_by_gmail_id(gmail_id):
+def check_if_email_exists_by_gmail_id(gmail_id, session=None):
     """Check if an email with the given unique Gmail ID exists in the database."""
-    with get_session() as session:
+    with session_scope(session) as session:
         exists = session.query(Email).filter(Email.gmail_id == gmail_id).first() is not None
     return exists
 
-def insert_blogpost(blogpost, slug):
+def get_emails_by_gmail_ids(gmail_ids, chunk_size=500, session=None):
+    """Get the stored emails with the given Gmail IDs, in the order of gmail_ids."""
+    emails_by_gmail_id = {}
+    with session_scope(session) as session:
+        for start in range(0, len(gmail_ids), chunk_size):
+            chunk = gmail_ids[start:start + chunk_size]
+            for email in session.query(Email).filter(Email.gmail_id.in_(chunk)):
+                emails_by_gmail_id[email.gmail_id] = email
+    return [emails_by_gmail_id[gmail_id] for gmail_id in gmail_ids if gmail_id in emails_by_gmail_id]
+
+def get_history_checkpoint(sync_key):
+    """Get the last synced Gmail historyId for the given sync key, or None if there is no checkpoint yet."""
+    with get_session() as session:
+        state = session.query(MailboxSyncState).filter(MailboxSyncState.sync_key == sync_key).first()
+    return state.history_id if state else None
+
+def save_history_checkpoint(sync_key, history_id):
+    """Store the last synced Gmail historyId for the given sync key."""
+    with get_session() as session:
+        state = session.query(MailboxSyncState).filter(MailboxSyncState.sync_key == sync_key).first()
+        if state:
+            state.history_id = str(history_id)
+        else:
+            session.add(MailboxSyncState(sync_key=sync_key, history_id=str(history_id)))
+
+def get_cached_llm_response(cache_key):
+    """Get the stored OpenAI response JSON for the cache key, or None if it is not cached."""
+    with get_session() as session:
+        return response_cache.get_cached_response(session, cache_key)
+
+def cache_llm_response(cache_key, model, response_json, total_tokens=0):
+    """Store an OpenAI response under the cache key and evict expired or excess entries."""
+    with get_session() as session:
+        response_cache.store_response(session, cache_key, model, response_json, total_tokens)
+        evicted = response_cache.evict_responses(session)
+    if evicted:
+        logging.info(f"Evicted {evicted} entries from the OpenAI response cache.")
+
+def delete_cached_llm_response(cache_key):
+    """Delete the stored OpenAI response of the cache key."""
+    with get_session() as session:
+        return response_cache.delete_response(session, cache_key)
+
+def insert_batch_job(batch_job):
+    """Store a submitted OpenAI batch job so later runs can collect its results."""
+    with get_session() as session:
+        session.add(batch_job)
+
+def get_open_batch_jobs():
+    """Get the OpenAI batch jobs whose results have not been collected yet, oldest first."""
+    with get_session() as session:
+        return session.query(OpenAIBatchJob).filter(OpenAIBatchJob.collected_at.is_(None)).order_by(OpenAIBatchJob.id).all()
+
+def mark_batch_request_collected(batch_id, custom_id, blogpost_id, session=None):
+    """Record in the manifest of an OpenAI batch job that the request custom_id became blog post blogpost_id.
+    Pass the session that inserted the blog post, so both are committed together."""
+    with session_scope(session) as session:
+        batch_job = session.query(OpenAIBatchJob).filter(OpenAIBatchJob.batch_id == batch_id).first()
+        if batch_job is None:
+            raise ValueError(f"No OpenAI batch job with batch id {batch_id}")
+        manifest = json.loads(batch_job.manifest)
+        manifest[custom_id]["blogpost_id"] = blogpost_id
+        batch_job.manifest = json.dumps(manifest)
+
+def update_batch_job(batch_id, **fields):
+    """Update the given columns of the OpenAI batch job with the given batch id."""
+    with get_session() as session:
+        batch_job = session.query(OpenAIBatchJob).filter(OpenAIBatchJob.batch_id == batch_id).first()
+        if batch_job is None:
+            raise ValueError(f"No OpenAI batch job with batch id {batch_id}")
+        for name, value in fields.items():
+            setattr(batch_job, name, value)
+
+def insert_blogpost(blogpost, slug, session=None):
     """Insert a new blog post into the database and return the created blog post."""
 
     if isinstance(blogpost.published_at, str):
@@ -109,26 +312,50 @@ def insert_blogpost(blogpost, slug):
 
     if isinstance(blogpost.tags, list):
         blogpost.tags = json.dumps(blogpost.tags)
-    
-    with get_session() as session:
-        session.add(blogpost)
-        session.commit()
-        session.refresh(blogpost)
 
-        if blogpost.blogpost_metadata:
-            _ = blogpost.blogpost_metadata
-            session.refresh(blogpost.blogpost_metadata)
+    if blogpost.blogpost_metadata and not blogpost.blogpost_metadata.slug:
+        blogpost.blogpost_metadata.slug = slug
 
-        if blogpost.blogpost_metadata and not blogpost.blogpost_metadata.slug:
-            blogpost.blogpost_metadata.slug = slug
-            session.commit()
-            session.refresh(blogpost.blogpost_metadata)
+    # A single flush writes the metadata and the post and fills in their ids and defaults
+    with session_scope(session) as session:
+        session.add(blogpost)
+        session.flush()
+        search_index.index_blogposts(session, [blogpost])
 
     return BlogPostDTO.from_orm(blogpost)
 
-def get_blogpost_by_id(post_id):
+def iter_blogposts(batch_size=100, blogpost_subject=None, status=None, since=None, until=None):
+    """Yield all blog posts as DTOs in id order, reading batch_size posts (with their metadata) per query.
+
+    since/until bound created_at (until exclusive).
+    """
+    filters = []
+    if blogpost_subject is not None:
+        filters.append(BlogPost.blogpost_subject == blogpost_subject)
+    if status is not None:
+        filters.append(BlogPost.status == status)
+    if since is not None:
+        filters.append(BlogPost.created_at >= since)
+    if until is not None:
+        filters.append(BlogPost.created_at < until)
+
+    last_id = 0
+    while True:
+        with get_session() as session:
+            batch = [
+                BlogPostDTO.from_orm(blogpost)
+                for blogpost in session.query(BlogPost).filter(BlogPost.id > last_id, *filters).order_by(BlogPost.id).limit(batch_size)
+            ]
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield from batch
+        if len(batch) < batch_size:
+            return
+
+def get_blogpost_by_id(post_id, session=None):
     """Retrieve a blog post and its metadata using metadata_id."""
-    with get_session() as session:
+    with session_scope(session) as session:
         blogpost = session.query(BlogPost).options(joinedload(BlogPost.blogpost_metadata)).filter(BlogPost.id == post_id).first()
         
         if blogpost:
@@ -137,21 +364,18 @@ def get_blogpost_by_id(post_id):
             
     return BlogPostDTO.from_orm(blogpost)
 
-def update_blogpost_status(post_id, new_status):
+def update_blogpost_status(post_id, new_status, session=None):
     """Update the status of a blog post and return the updated blog post."""
-    with get_session() as session:
+    with session_scope(session) as session:
         blogpost = session.query(BlogPost).filter(BlogPost.id == post_id).first()
         if blogpost:
             blogpost.status = new_status
-            session.commit()
-            session.refresh(blogpost)
-
 
     return BlogPostDTO.from_orm(blogpost)
 
-def update_blogpost(post_id, blogpost):
+def update_blogpost(post_id, blogpost, session=None):
     """Update an existing blog post and return the updated blog post."""
-    with get_session() as session:
+    with session_scope(session) as session:
         existing_blogpost = session.query(BlogPost).options(
             joinedload(BlogPost.blogpost_metadata)
         ).filter(BlogPost.id == post_id).first()
@@ -165,11 +389,9 @@ def update_blogpost(post_id, blogpost):
                 existing_blogpost.blogpost_metadata.description = blogpost.blogpost_metadata.description
                 existing_blogpost.blogpost_metadata.author = blogpost.blogpost_metadata.author
                 existing_blogpost.blogpost_metadata.image = blogpost.blogpost_metadata.image
-
-                session.merge(existing_blogpost.blogpost_metadata)
             else:
                 # If no metadata exists, assign the new metadata (this should happen only once)
-                existing_blogpost.blogpost_metadata = session.merge(blogpost.blogpost_metadata)
+                existing_blogpost.blogpost_metadata = session.merge(blogpost.blogpost_metadata.to_orm())
 
         # Iterate over the DTO's dictionary and update scalar fields
         for key, value in vars(blogpost).items():
@@ -181,54 +403,67 @@ def update_blogpost(post_id, blogpost):
                 value = json.dumps(value)  # Convert list to JSON string
             if key in ['created_at', 'published_at'] and isinstance(value, str):
                 value = convert_date(value)  # Convert string to datetime
+            if key == 'status' and isinstance(value, str):
+                value = BlogPostStatus(value)
+            if key == 'blogpost_subject' and isinstance(value, str):
+                value = BlogPostSubject(value)
             setattr(existing_blogpost, key, value)
-        
-        # Debug before merging the blogpost
-        blogpost_before = id(existing_blogpost)
-        
-        # Reattach the blogpost using merge
-        merged_blogpost = session.merge(existing_blogpost)
-        
-        session.commit()
-        session.refresh(merged_blogpost)
-        
-        updated_dto = BlogPostDTO.from_orm(merged_blogpost)
-        return updated_dto
 
-def insert_blogpost_metadata(metadata):
+        # The loaded post is already part of the session, so one flush writes all changes
+        session.flush()
+        search_index.index_blogposts(session, [existing_blogpost])
+        return BlogPostDTO.from_orm(existing_blogpost)
+
+def insert_blogpost_metadata(metadata, session=None):
     """Insert a new blog post metadata into the database and return the created metadata."""
 
     if isinstance(metadata.date, str):
         metadata.date = convert_date(metadata.date)
     
-    with get_session() as session:
+    with session_scope(session) as session:
         session.add(metadata)
-        session.commit()
-        session.refresh(metadata)
+        session.flush()
     return BlogPostMetadataDTO.from_orm(metadata)
 
-def get_blogpost_metadata_by_id(metadata_id):
+def get_blogpost_metadata_by_id(metadata_id, session=None):
     """Retrieve blog post metadata by ID and convert JSON fields back to Python lists."""
-    with get_session() as session:
+    with session_scope(session) as session:
         metadata = session.query(BlogPostMetadata).filter(BlogPostMetadata.id == metadata_id).first()
         # if metadata:
             # metadata.date = metadata.date.isoformat() if metadata.date else None
     return BlogPostMetadataDTO.from_orm(metadata)
 
-def update_blogpost_metadata(metadata_id, metadata):
+def update_blogpost_metadata(metadata_id, metadata, session=None):
     """Update an existing blog post metadata and return updated metadata."""
-    with get_session() as session:
+    with session_scope(session) as session:
         existing_metadata = session.query(BlogPostMetadata).filter(BlogPostMetadata.id == metadata_id).first()
         if existing_metadata:
             for key, value in metadata.__dict__.items():
                 if key == 'date' and isinstance(value, str):
                     value = convert_date(value)  # Convert string to datetime
                 setattr(existing_metadata, key, value)
-            session.commit()
-            session.refresh(existing_metadata)
             # existing_metadata.date = existing_metadata.date.isoformat() if existing_metadata.date else None
     return BlogPostMetadataDTO.from_orm(existing_metadata)
     
+def search_emails(query, limit=20, session=None):
+    """Full-text search over the stored emails. Returns (email, score) pairs, best match first."""
+    with session_scope(session) as session:
+        matches = search_index.search_index(session, query, "emails", limit)
+        emails_by_id = {email.id: email for email in session.query(Email).filter(Email.id.in_([email_id for email_id, _ in matches]))}
+    return [(emails_by_id[email_id], score) for email_id, score in matches if email_id in emails_by_id]
+
+def search_blogposts(query, limit=20, session=None):
+    """Full-text search over the blog posts. Returns (blog post DTO, score) pairs, best match first."""
+    with session_scope(session) as session:
+        matches = search_index.search_index(session, query, "blogposts", limit)
+        blogposts_by_id = {blogpost.id: blogpost for blogpost in session.query(BlogPost).filter(BlogPost.id.in_([post_id for post_id, _ in matches]))}
+        return [(BlogPostDTO.from_orm(blogposts_by_id[post_id]), score) for post_id, score in matches if post_id in blogposts_by_id]
+
+def rebuild_search_index():
+    """Rebuild the full-text search index from the stored emails and blog posts. Returns both counts."""
+    with get_session() as session:
+        return search_index.rebuild_search_index(session)
+
 def convert_date(date_str):
     # Extract the main date-time part (before optional "(UTC)" or other extras)
     match = re.match(r"^(.*?\+\d{4})", date_str)
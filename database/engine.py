@@ -0,0 +1,85 @@
+import logging
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+load_dotenv("config/environment_variables.env")
+
+# Set DATABASE_ECHO=true to log every SQL statement
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "false").lower() in ("1", "true", "yes")
+
+# SQLite: WAL lets readers and the single writer work at the same time, and synchronous=NORMAL
+# only syncs the WAL at checkpoints instead of on every commit
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+
+# Connection pool for server databases
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", "1800"))
+
+def is_memory_database(url):
+    """True for an in-memory SQLite URL, where every connection would otherwise see its own empty database."""
+    return url.database in (None, "", ":memory:") or url.query.get("mode") == "memory"
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applies the SQLite performance profile to every new connection."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+def create_sqlite_engine(url, echo):
+    """Creates a SQLite engine with WAL and tuned pragmas, or a single shared connection for :memory:."""
+    if is_memory_database(url):
+        return create_engine(url, echo=echo, poolclass=StaticPool, connect_args={"check_same_thread": False})
+
+    engine = create_engine(
+        url,
+        echo=echo,
+        poolclass=QueuePool,
+        pool_size=DATABASE_POOL_SIZE,
+        max_overflow=DATABASE_MAX_OVERFLOW,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000, "check_same_thread": False},
+    )
+    event.listen(engine, "connect", apply_sqlite_pragmas)
+    return engine
+
+def create_postgres_engine(url, echo):
+    """Creates a PostgreSQL engine with an explicitly sized pool that checks connections before use."""
+    return create_engine(
+        url,
+        echo=echo,
+        pool_size=DATABASE_POOL_SIZE,
+        max_overflow=DATABASE_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=DATABASE_POOL_RECYCLE,
+    )
+
+def create_database_engine(database_url, echo=DATABASE_ECHO):
+    """Creates an engine with the performance profile that matches the backend of database_url."""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        return create_sqlite_engine(url, echo)
+    if backend == "postgresql":
+        return create_postgres_engine(url, echo)
+    return create_engine(url, echo=echo, pool_pre_ping=True)
+
+def close_database_engine(engine):
+    """Closes all pooled connections. For SQLite the WAL is first checkpointed into the database file,
+    so the .db file is complete on its own (it is committed to the repository after each run)."""
+    if engine.dialect.name == "sqlite" and not is_memory_database(engine.url):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        except Exception as e:
+            logging.warning(f"Could not checkpoint the SQLite WAL: {e}")
+    engine.dispose()
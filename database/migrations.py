@@ -0,0 +1,154 @@
+import logging
+from sqlalchemy import func, insert, inspect, select, text
+from sqlalchemy.orm import Session
+from entities.Email import Email
+from entities.Blogpost import BlogPost
+from entities.Blogpost_metadata import BlogPostMetadata
+from entities.Schema_migration import SchemaMigration
+from entities.Email_body import EmailBody
+from database.body_store import store_email_bodies
+from database.search_index import create_search_tables, rebuild_search_index
+from database.types import compress_text, decompress_text, is_compressed
+
+# create_all only creates missing tables, so every schema change to an existing table is a migration.
+# Migrations run in version order, each in its own transaction, and are recorded in schema_migrations.
+
+def create_indexes(connection, table, index_names):
+    """Creates the named indexes of a mapped table unless they already exist."""
+    for index in table.indexes:
+        if index.name in index_names:
+            index.create(connection, checkfirst=True)
+
+def rename_duplicate_slugs(connection):
+    """Gives every slug that is used more than once a -2, -3, ... suffix, except on its oldest row,
+    so the unique slug index can be created. Returns the (old slug, new slug) pairs."""
+    metadata_table = BlogPostMetadata.__table__
+    duplicate_slugs = connection.execute(
+        select(metadata_table.c.slug)
+        .where(metadata_table.c.slug.is_not(None))
+        .group_by(metadata_table.c.slug)
+        .having(func.count() > 1)
+    ).scalars().all()
+    if not duplicate_slugs:
+        return []
+
+    used_slugs = set(connection.execute(select(metadata_table.c.slug).where(metadata_table.c.slug.is_not(None))).scalars())
+    renamed = []
+    for slug in duplicate_slugs:
+        row_ids = connection.execute(
+            select(metadata_table.c.id).where(metadata_table.c.slug == slug).order_by(metadata_table.c.id)
+        ).scalars().all()
+        suffix = 2
+        for row_id in row_ids[1:]:
+            while f"{slug}-{suffix}" in used_slugs:
+                suffix += 1
+            new_slug = f"{slug}-{suffix}"
+            used_slugs.add(new_slug)
+            connection.execute(metadata_table.update().where(metadata_table.c.id == row_id).values(slug=new_slug))
+            renamed.append((slug, new_slug))
+    return renamed
+
+def add_query_indexes(connection):
+    """Adds the composite indexes for the email, blog post and slug lookups."""
+    for slug, new_slug in rename_duplicate_slugs(connection):
+        # Markdown files that were already written keep their file name
+        logging.warning(f"Blog post slug {slug} was used more than once, renamed a later post to {new_slug}.")
+
+    create_indexes(connection, Email.__table__, {'ix_emails_date', 'ix_emails_published_date', 'ix_emails_sender_email_date'})
+    create_indexes(connection, BlogPost.__table__, {'ix_blogposts_subject_status_created_at', 'ix_blogposts_blogpost_metadata_id'})
+    create_indexes(connection, BlogPostMetadata.__table__, {'ux_blog_post_metadata_slug'})
+
+def add_search_index(connection):
+    """Creates the full-text search tables. They are filled once all migrations have run."""
+    create_search_tables(connection)
+
+COMPRESSED_COLUMNS = [("emails", "body"), ("blogposts", "content"), ("blogposts", "prompt_used")]
+COMPRESSION_BATCH_SIZE = 500
+
+def get_column_data_type(connection, table, column):
+    """Returns the PostgreSQL data type of a column, e.g. text or bytea."""
+    return connection.execute(
+        text("SELECT data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"),
+        {"table": table, "column": column},
+    ).scalar()
+
+def compress_existing_rows(connection):
+    """Rewrites the text stored in the CompressedText columns in compressed form, batch by batch."""
+    for table, column in COMPRESSED_COLUMNS:
+        if connection.dialect.name == "postgresql" and get_column_data_type(connection, table, column) in ("text", "character varying"):
+            connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BYTEA USING convert_to({column}, 'UTF8')"))
+        last_id = 0
+        while True:
+            rows = connection.execute(
+                text(f"SELECT id, {column} FROM {table} WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": COMPRESSION_BATCH_SIZE},
+            ).all()
+            if not rows:
+                break
+            updates = [
+                {"id": row_id, "value": compress_text(decompress_text(value))}
+                for row_id, value in rows
+                if value is not None and not is_compressed(value)
+            ]
+            if updates:
+                connection.execute(text(f"UPDATE {table} SET {column} = :value WHERE id = :id"), updates)
+            last_id = rows[-1][0]
+
+def move_bodies_to_body_store(connection):
+    """Adds emails.body_hash and moves every inline email body to the shared email_bodies store."""
+    EmailBody.__table__.create(connection, checkfirst=True)
+    if "body_hash" not in {column["name"] for column in inspect(connection).get_columns("emails")}:
+        connection.execute(text("ALTER TABLE emails ADD COLUMN body_hash VARCHAR(64) REFERENCES email_bodies (body_hash)"))
+    create_indexes(connection, Email.__table__, {'ix_emails_body_hash'})
+
+    with Session(bind=connection) as session:
+        last_id = 0
+        while True:
+            emails = session.query(Email).filter(Email.id > last_id, Email.body_hash.is_(None)).order_by(Email.id).limit(COMPRESSION_BATCH_SIZE).all()
+            if not emails:
+                break
+            store_email_bodies(session, emails)
+            session.flush()
+            last_id = emails[-1].id
+            session.expunge_all()
+
+MIGRATIONS = [
+    (1, "Add indexes for the hot query paths", add_query_indexes),
+    (2, "Add the full-text search index", add_search_index),
+    (3, "Compress email bodies and blog post content", compress_existing_rows),
+    (4, "Store email bodies once per distinct content", move_bodies_to_body_store),
+]
+# The search index is filled through the ORM, so only after the schema matches the entities again
+REBUILD_SEARCH_INDEX_AFTER_VERSIONS = {2}
+# SQLite only returns the freed pages to the file system on VACUUM
+VACUUM_AFTER_VERSIONS = {3, 4}
+
+def get_applied_versions(connection):
+    """Returns the versions recorded in schema_migrations."""
+    return set(connection.execute(select(SchemaMigration.version)).scalars())
+
+def run_migrations(engine):
+    """Applies the migrations that have not been applied to this database yet and returns their versions."""
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        applied_versions = get_applied_versions(connection)
+
+    newly_applied = []
+    for version, name, migration in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied_versions:
+            continue
+        logging.info(f"Applying schema migration {version}: {name}")
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(insert(SchemaMigration).values(version=version, name=name))
+        newly_applied.append(version)
+
+    if REBUILD_SEARCH_INDEX_AFTER_VERSIONS.intersection(newly_applied):
+        with Session(engine) as session:
+            rebuild_search_index(session)
+            session.commit()
+
+    if engine.dialect.name == "sqlite" and VACUUM_AFTER_VERSIONS.intersection(newly_applied):
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            connection.execute(text("VACUUM"))
+    return newly_applied
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlalchemy import func
+from entities.Llm_response import LlmResponse
+
+load_dotenv("config/environment_variables.env")
+
+# OpenAI responses are stored under the hash of every request parameter, so a rerun that sends the
+# same request gets the stored answer back instead of paying for it again. Entries expire after
+# LLM_CACHE_MAX_AGE_DAYS and the least recently used ones are evicted above LLM_CACHE_MAX_BYTES.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_MAX_AGE_DAYS = int(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "14"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(20 * 1024 * 1024)))
+# Part of every key, so changing how responses are stored invalidates the old entries
+CACHE_KEY_VERSION = 1
+
+# Hits and misses of this process, reported at the end of a run
+cache_stats = Counter()
+
+def make_cache_key(parameters):
+    """Returns the hex sha256 of the request parameters, independent of their order."""
+    payload = json.dumps({"version": CACHE_KEY_VERSION, **parameters}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_response(session, cache_key):
+    """Returns the stored response JSON for cache_key and counts the hit, or None (a miss)."""
+    entry = session.get(LlmResponse, cache_key)
+    if entry is None or entry.created_at < datetime.utcnow() - timedelta(days=LLM_CACHE_MAX_AGE_DAYS):
+        cache_stats["misses"] += 1
+        return None
+    entry.hit_count += 1
+    entry.last_used_at = datetime.utcnow()
+    cache_stats["hits"] += 1
+    return entry.response
+
+def store_response(session, cache_key, model, response_json, total_tokens=0):
+    """Stores a response under cache_key, replacing an expired entry with the same key."""
+    session.merge(LlmResponse(
+        cache_key=cache_key,
+        model=model,
+        response=response_json,
+        size=len(response_json.encode("utf-8")),
+        total_tokens=total_tokens or 0,
+        hit_count=0,
+        created_at=datetime.utcnow(),
+        last_used_at=datetime.utcnow(),
+    ))
+    session.flush()
+
+def delete_response(session, cache_key):
+    """Deletes the entry of cache_key, e.g. a response that turned out to be unusable. Returns True if there was one."""
+    return session.query(LlmResponse).filter(LlmResponse.cache_key == cache_key).delete(synchronize_session=False) > 0
+
+def evict_responses(session):
+    """Deletes expired entries, then the least recently used ones until the cache fits LLM_CACHE_MAX_BYTES.
+    Returns the number of deleted entries."""
+    deleted = session.query(LlmResponse).filter(
+        LlmResponse.created_at < datetime.utcnow() - timedelta(days=LLM_CACHE_MAX_AGE_DAYS)
+    ).delete(synchronize_session=False)
+
+    excess = (session.query(func.coalesce(func.sum(LlmResponse.size), 0)).scalar() or 0) - LLM_CACHE_MAX_BYTES
+    if excess > 0:
+        keys = []
+        for cache_key, size in session.query(LlmResponse.cache_key, LlmResponse.size).order_by(LlmResponse.last_used_at):
+            if excess <= 0:
+                break
+            keys.append(cache_key)
+            excess -= size
+        deleted += session.query(LlmResponse).filter(LlmResponse.cache_key.in_(keys)).delete(synchronize_session=False)
+    return deleted
@@ -0,0 +1,146 @@
+import re
+from sqlalchemy import text
+from entities.Email import Email
+from entities.Blogpost import BlogPost
+from email_processing.html_to_text import html_to_text
+
+# Full-text search over emails and blog posts.
+# SQLite: FTS5 tables whose rowid is the id of the indexed row. emails_fts is contentless, so the
+# bodies are not stored a second time. Emails never change once stored. blogposts_fts keeps its
+# content so a post can be re-indexed when it is updated.
+# PostgreSQL: a side table per source with a tsvector document and a GIN index.
+# The text is always passed in from Python, so the index does not depend on how rows store it.
+
+SEARCH_TARGETS = ("emails", "blogposts")
+REBUILD_BATCH_SIZE = 500
+EMAIL_COLUMN_WEIGHTS = (5.0, 2.0, 1.0)  # subject, sender_name, body
+BLOGPOST_COLUMN_WEIGHTS = (5.0, 3.0, 1.0, 2.0)  # title, description, content, tags
+SEARCH_TERM_REGEX = re.compile(r'\w+', re.UNICODE)
+
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(subject, sender_name, body, content='', tokenize='porter unicode61')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS blogposts_fts USING fts5(title, description, content, tags, tokenize='porter unicode61')",
+]
+POSTGRES_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS emails_fts (rowid INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_emails_fts_document ON emails_fts USING GIN (document)",
+    "CREATE TABLE IF NOT EXISTS blogposts_fts (rowid INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_blogposts_fts_document ON blogposts_fts USING GIN (document)",
+]
+# Weighted document: A for the title/subject, B for the description/sender, C for tags, D for the text
+POSTGRES_EMAIL_DOCUMENT = (
+    "setweight(to_tsvector('english', :subject), 'A') || setweight(to_tsvector('english', :sender_name), 'B')"
+    " || setweight(to_tsvector('english', :body), 'D')"
+)
+POSTGRES_BLOGPOST_DOCUMENT = (
+    "setweight(to_tsvector('english', :title), 'A') || setweight(to_tsvector('english', :description), 'B')"
+    " || setweight(to_tsvector('english', :tags), 'C') || setweight(to_tsvector('english', :content), 'D')"
+)
+
+def get_dialect_name(connection):
+    """Returns the dialect name of a session or connection."""
+    return connection.get_bind().dialect.name if hasattr(connection, "get_bind") else connection.dialect.name
+
+def create_search_tables(connection):
+    """Creates the search tables for the backend of the connection."""
+    for statement in (SQLITE_SCHEMA if get_dialect_name(connection) == "sqlite" else POSTGRES_SCHEMA):
+        connection.execute(text(statement))
+
+def get_email_document(email):
+    """Returns the indexed text of an email."""
+    return {"rowid": email.id, "subject": email.subject or "", "sender_name": email.sender_name or "", "body": email.body or ""}
+
+def get_blogpost_document(blogpost):
+    """Returns the indexed text of a blog post, with the HTML content reduced to plain text."""
+    metadata = blogpost.blogpost_metadata
+    tags = blogpost.tags if isinstance(blogpost.tags, str) else " ".join(blogpost.tags or [])
+    return {
+        "rowid": blogpost.id,
+        "title": metadata.title if metadata else "",
+        "description": metadata.description if metadata else "",
+        "content": html_to_text(blogpost.content or ""),
+        "tags": tags or "",
+    }
+
+def index_emails(connection, emails):
+    """Adds stored emails to the search index. Emails are indexed once, when they are inserted."""
+    documents = [get_email_document(email) for email in emails]
+    if not documents:
+        return
+    if get_dialect_name(connection) == "sqlite":
+        statement = "INSERT INTO emails_fts (rowid, subject, sender_name, body) VALUES (:rowid, :subject, :sender_name, :body)"
+    else:
+        statement = (
+            f"INSERT INTO emails_fts (rowid, document) VALUES (:rowid, {POSTGRES_EMAIL_DOCUMENT}) "
+            "ON CONFLICT (rowid) DO UPDATE SET document = EXCLUDED.document"
+        )
+    connection.execute(text(statement), documents)
+
+def index_blogposts(connection, blogposts):
+    """Adds stored blog posts to the search index, replacing their previous entry."""
+    documents = [get_blogpost_document(blogpost) for blogpost in blogposts]
+    if not documents:
+        return
+    if get_dialect_name(connection) == "sqlite":
+        connection.execute(text("DELETE FROM blogposts_fts WHERE rowid = :rowid"), [{"rowid": d["rowid"]} for d in documents])
+        statement = "INSERT INTO blogposts_fts (rowid, title, description, content, tags) VALUES (:rowid, :title, :description, :content, :tags)"
+    else:
+        statement = (
+            f"INSERT INTO blogposts_fts (rowid, document) VALUES (:rowid, {POSTGRES_BLOGPOST_DOCUMENT}) "
+            "ON CONFLICT (rowid) DO UPDATE SET document = EXCLUDED.document"
+        )
+    connection.execute(text(statement), documents)
+
+def rebuild_search_index(session, batch_size=REBUILD_BATCH_SIZE):
+    """Empties the search index and indexes every stored email and blog post again, batch by batch.
+
+    Returns the number of indexed emails and blog posts.
+    """
+    if get_dialect_name(session) == "sqlite":
+        session.execute(text("INSERT INTO emails_fts (emails_fts) VALUES ('delete-all')"))
+        session.execute(text("DELETE FROM blogposts_fts"))
+    else:
+        session.execute(text("DELETE FROM emails_fts"))
+        session.execute(text("DELETE FROM blogposts_fts"))
+
+    counts = []
+    for entity, index in ((Email, index_emails), (BlogPost, index_blogposts)):
+        count = 0
+        last_id = 0
+        while True:
+            rows = session.query(entity).filter(entity.id > last_id).order_by(entity.id).limit(batch_size).all()
+            if not rows:
+                break
+            index(session, rows)
+            count += len(rows)
+            last_id = rows[-1].id
+            session.expunge_all()  # Keep memory flat on large archives
+        counts.append(count)
+    return tuple(counts)
+
+def build_match_query(query):
+    """Turns free text into an FTS5 query that matches rows containing every word, with no operators."""
+    return " ".join(f'"{term}"' for term in SEARCH_TERM_REGEX.findall(query))
+
+def search_index(session, query, target="emails", limit=20):
+    """Returns (id, score) pairs of the best matches for query in target, best first."""
+    if target not in SEARCH_TARGETS:
+        raise ValueError(f"Unknown search target: {target}")
+    match_query = build_match_query(query)
+    if not match_query:
+        return []
+
+    if get_dialect_name(session) == "sqlite":
+        weights = ", ".join(str(weight) for weight in (EMAIL_COLUMN_WEIGHTS if target == "emails" else BLOGPOST_COLUMN_WEIGHTS))
+        statement = (
+            f"SELECT rowid, -bm25({target}_fts, {weights}) AS score FROM {target}_fts "
+            f"WHERE {target}_fts MATCH :query ORDER BY bm25({target}_fts, {weights}) LIMIT :limit"
+        )
+        parameters = {"query": match_query, "limit": limit}
+    else:
+        statement = (
+            f"SELECT rowid, ts_rank_cd(document, plainto_tsquery('english', :query)) AS score FROM {target}_fts "
+            f"WHERE document @@ plainto_tsquery('english', :query) ORDER BY score DESC LIMIT :limit"
+        )
+        parameters = {"query": query, "limit": limit}
+    return [(row.rowid, row.score) for row in session.execute(text(statement), parameters)]
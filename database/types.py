@@ -0,0 +1,68 @@
+import logging
+import os
+import zlib
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+try:
+    import zstandard  # Optional, zlib is used without it
+except ImportError:
+    zstandard = None
+
+# Every stored value starts with a format byte, so the algorithm can change without rewriting old rows
+FORMAT_UNCOMPRESSED = 0
+FORMAT_ZLIB = 1
+FORMAT_ZSTD = 2
+
+# Values shorter than this are stored uncompressed, compressing them would save nothing
+MIN_COMPRESSED_BYTES = 128
+COMPRESSION_ALGORITHM = os.getenv("COMPRESSION_ALGORITHM", "zlib").lower()
+ZLIB_LEVEL = int(os.getenv("ZLIB_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "6"))
+
+if COMPRESSION_ALGORITHM == "zstd" and zstandard is None:
+    logging.warning("COMPRESSION_ALGORITHM=zstd but the zstandard package is not installed. Using zlib.")
+    COMPRESSION_ALGORITHM = "zlib"
+
+def compress_text(value):
+    """Encodes text as UTF-8 and compresses it, prefixed with the format byte."""
+    raw = value.encode("utf-8")
+    if len(raw) < MIN_COMPRESSED_BYTES:
+        return bytes([FORMAT_UNCOMPRESSED]) + raw
+    if COMPRESSION_ALGORITHM == "zstd":
+        return bytes([FORMAT_ZSTD]) + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return bytes([FORMAT_ZLIB]) + zlib.compress(raw, ZLIB_LEVEL)
+
+def decompress_text(value):
+    """Decodes a value written by compress_text. Rows stored before compression was added
+    come back as str (SQLite) or as UTF-8 bytes without a format byte and are returned as they are."""
+    if isinstance(value, str):
+        return value
+    value = bytes(value)
+    if not value:
+        return ""
+    data_format, data = value[0], value[1:]
+    if data_format == FORMAT_UNCOMPRESSED:
+        return data.decode("utf-8")
+    if data_format == FORMAT_ZLIB:
+        return zlib.decompress(data).decode("utf-8")
+    if data_format == FORMAT_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("This value is compressed with zstd. Install the zstandard package to read it.")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return value.decode("utf-8")  # Legacy uncompressed UTF-8, its first byte is printable text
+
+def is_compressed(value):
+    """True if a raw column value was written by compress_text."""
+    return isinstance(value, (bytes, memoryview)) and len(value) > 0 and bytes(value[:1])[0] in (FORMAT_UNCOMPRESSED, FORMAT_ZLIB, FORMAT_ZSTD)
+
+class CompressedText(TypeDecorator):
+    """Text column that is stored compressed as a binary value and read back as str."""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else decompress_text(value)
@@ -0,0 +1,77 @@
+import re
+
+# All patterns are compiled once at import. Links, promotional and sponsor lines, phone numbers and
+# citations are merged into a single alternation. Emojis get their own scan first, because removing
+# them creates the word boundaries the other patterns rely on, so a body is scanned three times
+# instead of seven.
+URL_PATTERN = r'http[s]?://\S+'
+PROMOTION_PATTERN = r'(?i:\b(?:SIGN UP|ADVERTISE|VIEW ONLINE|GET STARTED HERE|APPLY HERE|TRACK YOUR REFERRALS|SHARE YOUR REFERRAL LINK|MANAGE YOUR SUBSCRIPTIONS|UNSUBSCRIBE|TOGETHER WITH|SPONSORED BY|SPONSOR)\b.*)'
+PHONE_NUMBER_PATTERN = r'\b\d{3}[-.\s]?\d{3}[-.\s]?\d{4}\b'
+CITATION_PATTERN = r'\[\d+\]'
+EMOJI_PATTERN = (
+    "["
+    "\U0001F600-\U0001F64F"  # Emoticons
+    "\U0001F300-\U0001F5FF"  # Symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # Transport & map symbols
+    "\U0001F700-\U0001F77F"  # Alchemical symbols
+    "\U0001F780-\U0001F7FF"  # Geometric shapes
+    "\U0001F800-\U0001F8FF"  # Supplemental arrows
+    "\U0001F900-\U0001F9FF"  # Supplemental symbols
+    "\U0001FA00-\U0001FA6F"  # Chess symbols
+    "\U0001FA70-\U0001FAFF"  # Other symbols
+    "\U00002702-\U000027B0"  # Dingbats
+    "\U000024C2-\U0001F251"
+    "]+"
+)
+
+# The regex engine tries every alternative at every position. A lookahead on the characters the
+# alternatives can start with lets it skip all other positions after a single check.
+REMOVAL_FIRST_CHARACTERS = r'(?=[h\[\dAaGgMmSsTtUuVv\u017f])'
+EMOJI_FIRST_CHARACTERS = '(?=[\u24c2-\U0001FAFF])'
+
+EMOJI_REGEX = re.compile(EMOJI_FIRST_CHARACTERS + EMOJI_PATTERN)
+REMOVAL_REGEX = re.compile(REMOVAL_FIRST_CHARACTERS + "(?:" + "|".join([URL_PATTERN, PROMOTION_PATTERN, PHONE_NUMBER_PATTERN, CITATION_PATTERN]) + ")")
+BLANK_LINES_REGEX = re.compile(r'\n\s*\n')
+
+def clean_body(text):
+    """Cleans a newsletter body in three scans: emojis, everything else that is removed, and blank lines.
+
+    Gives the same result as remove_emojis followed by clean_newsletter_body, except that lines left
+    empty by a removed citation are collapsed as well, and that a phone number or promotional phrase
+    glued directly onto a removed link or citation is kept (the sequential passes cut those apart first).
+    """
+    text = REMOVAL_REGEX.sub('', EMOJI_REGEX.sub('', text))
+    text = BLANK_LINES_REGEX.sub('\n', text)
+    return text.strip()
+
+def clean_body_stream(chunks):
+    """Cleans a newsletter body that arrives in chunks and yields the cleaned text piece by piece.
+
+    Only complete lines are cleaned, so the output matches clean_body as long as no phone number
+    is split over two lines. Memory use is bounded by the chunk size plus the longest line.
+    """
+    pending = ""
+    first_line = True
+    held_line = None  # The last non-blank line is held back so the end of the body can be stripped
+
+    def emit(lines):
+        nonlocal first_line, held_line
+        for line in lines:
+            if not line or line.isspace():
+                continue
+            if held_line is not None:
+                yield held_line
+            held_line = line.lstrip() if first_line else "\n" + line
+            first_line = False
+
+    for chunk in chunks:
+        pending += chunk
+        cut = pending.rfind("\n")
+        if cut == -1:
+            continue
+        block, pending = pending[:cut], pending[cut + 1:]
+        yield from emit(REMOVAL_REGEX.sub('', EMOJI_REGEX.sub('', block)).split("\n"))
+
+    yield from emit([REMOVAL_REGEX.sub('', EMOJI_REGEX.sub('', pending))])
+    if held_line is not None:
+        yield held_line.rstrip()
@@ -1,49 +1,301 @@
 import os
-import base64
+import logging
 from email.utils import parseaddr
 import re
 from googleapiclient.discovery import build
-from blog.blogpost_creator import create_blogpost
+from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 from entities.Email import Email  # Adjust the import path as necessary
 from enums.gmail_labels import GmailLabels  # Adjust the import path as necessary
+from email_processing.body_cleaner import clean_body
+from email_processing.mime_extraction import build_part_fields, decode_part_bytes, decode_part_text, extract_body_text, find_part, get_part_charset, get_raw_part_bytes, inline_data_size, part_to_text, select_body_part
+from email_processing.label_mutations import batch_modify_labels
+from rate_limiting.rate_limiter import GMAIL_QUOTA_COSTS, MAX_RETRIES, backoff_delay, call_with_rate_limit, execute_gmail_request, get_bucket, get_rate_limit_delay
+from database.db_operations import get_history_checkpoint
 
 # Load environment variables
 load_dotenv(dotenv_path="config/environment_variables.env")
 
 GMAIL_EMAIL = os.getenv("GMAIL_EMAIL")
 
+# PUBLISHED -> Label_3076953365604997473
+# PARSED -> Label_6126309069161477633
+PUBLISHED_LABEL_ID = "Label_3076953365604997473"
+PARSED_LABEL_ID = "Label_6126309069161477633"
+
+# Gmail accepts up to 100 calls per batch request but recommends staying at or below 50
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+
+# Partial responses: the first request reads the headers and the part tree without any part data,
+# the second one only the data needed for the body
+PART_TREE_FIELDS = "id,sizeEstimate," + build_part_fields("partId,mimeType,filename,headers,body/size,body/attachmentId")
+PART_DATA_FIELDS = build_part_fields("partId,body/data")
+# format="raw" is fetched instead when the raw message is at most this much larger than the inline part data
+RAW_FETCH_SLACK_BYTES = int(os.getenv("GMAIL_RAW_FETCH_SLACK_BYTES", "8192"))
+
+# Window scanned when there is no usable history checkpoint
+SUNDAY_WINDOW_DAYS = 7
+WEDNESDAY_WINDOW_DAYS = 3
+
+def build_sender_query(newsletters):
+    """Builds the Gmail query part matching any of the given sender addresses."""
+    return ' OR '.join([f'from:{sender}' for sender in newsletters if isinstance(sender, str) and '@' in sender])
+
 def fetch_sunday_emails(service, newsletters):
     """Fetches AI newsletter emails from the past week on Sunday."""
-    query = ' OR '.join([f'from:{sender}' for sender in newsletters if isinstance(sender, str) and '@' in sender]) + ' newer_than:7d'  # Fetch last 7 days
+    query = build_sender_query(newsletters) + f' newer_than:{SUNDAY_WINDOW_DAYS}d'  # Fetch last 7 days
     print(f"Constructed Query (Sunday Fetch): {query}")  # Debugging statement
     return fetch_emails(service, query)
 
 
 def fetch_wednesday_emails(service, newsletters):
     """Fetches AI newsletter emails from Sunday to Wednesday (3-day window)."""
-    query = ' OR '.join([f'from:{sender}' for sender in newsletters if isinstance(sender, str) and '@' in sender]) + ' newer_than:3d'  # Fetch last 3 days
+    query = build_sender_query(newsletters) + f' newer_than:{WEDNESDAY_WINDOW_DAYS}d'  # Fetch last 3 days
     print(f"Constructed Query (Wednesday Fetch): {query}")  # Debugging statement
     return fetch_emails(service, query)
 
+def fetch_emails_incremental(service, newsletters, sync_key, window_days, pending_checkpoints):
+    """Yields newsletter emails added since the stored history checkpoint for sync_key.
+
+    Without a checkpoint, or when Gmail reports it as expired, this falls back to
+    scanning the last window_days. Once every email has been yielded, the new historyId is put in
+    pending_checkpoints[sync_key]; the caller saves it after the blog posts of these emails succeeded.
+    """
+    start_history_id = get_history_checkpoint(sync_key)
+    message_ids = None
+
+    if start_history_id:
+        try:
+            message_ids, latest_history_id = list_message_ids_added_since(service, "me", start_history_id)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logging.warning(f"History checkpoint {start_history_id} for {sync_key} has expired. Falling back to a {window_days}-day scan.")
+
+    if message_ids is None:
+        # Read the current historyId before scanning, so mail arriving during the scan is picked up next time
+        latest_history_id = get_current_history_id(service, "me")
+        query = build_sender_query(newsletters) + f' newer_than:{window_days}d'
+        print(f"Constructed Query (Full Window Fetch): {query}")  # Debugging statement
+        yield from fetch_emails(service, query)
+    else:
+        print(f"Number of messages added since history {start_history_id}: {len(message_ids)}")  # Debugging statement
+        yield from fetch_emails_by_ids(service, filter_message_ids_by_sender(service, "me", message_ids, newsletters))
+
+    pending_checkpoints[sync_key] = latest_history_id
+
+def get_current_history_id(service, user_id):
+    """Returns the mailbox's current historyId."""
+    return execute_gmail_request(service.users().getProfile(userId=user_id), "getProfile")["historyId"]
+
+def list_message_ids_added_since(service, user_id, start_history_id):
+    """Lists the ids of messages added to the mailbox after start_history_id, following every history page.
+
+    Returns the message ids and the latest historyId of the mailbox. Raises HttpError 404 when
+    start_history_id is too old for Gmail to serve.
+    """
+    message_ids = []
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        response = execute_gmail_request(service.users().history().list(
+            userId=user_id,
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            pageToken=page_token
+        ), "history.list")
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                if {"SENT", "DRAFT"} & set(message.get("labelIds", [])):
+                    continue
+                message_ids.append(message["id"])
+        latest_history_id = response.get("historyId", latest_history_id)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+    return list(dict.fromkeys(message_ids)), latest_history_id
+
+def filter_message_ids_by_sender(service, user_id, email_ids, newsletters):
+    """Keeps the ids of messages sent by one of the newsletters, reading only their From header."""
+    senders = {sender.lower() for sender in newsletters if isinstance(sender, str) and '@' in sender}
+    matching_ids = set()
+
+    def handle_response(request_id, response, exception):
+        if exception is not None:
+            logging.error(f"Error fetching headers of email {request_id}: {exception}")
+            return
+        headers = response.get("payload", {}).get("headers", [])
+        sender = next((h["value"] for h in headers if h["name"] == "From"), "")
+        if parseaddr(sender)[1].lower() in senders:
+            matching_ids.add(request_id)
+
+    requests_by_id = {
+        email_id: service.users().messages().get(userId=user_id, id=email_id, format="metadata", metadataHeaders=["From"], fields="payload/headers")
+        for email_id in email_ids
+    }
+    execute_in_batches(service, requests_by_id, handle_response)
+    return [email_id for email_id in email_ids if email_id in matching_ids]
+
 
 def fetch_emails(service, query):
-    """Fetches newsletter emails based on a given Gmail query."""
-    results = service.users().messages().list(userId="me", q=query).execute()
-    messages = results.get("messages", [])
-    
-    print(f"Number of messages found: {len(messages)}")  # Debugging statement
-    
-    if not messages:
+    """Fetches newsletter emails based on a given Gmail query.
+
+    Returns a generator that follows every result page and yields Email objects
+    batch by batch, so only one batch of bodies is held in memory at a time.
+    """
+    return fetch_emails_by_ids(service, iter_message_ids(service, "me", query))
+
+def iter_message_ids(service, user_id, query):
+    """Yields the ids of all messages matching the query, following nextPageToken across result pages."""
+    page_token = None
+    message_count = 0
+    while True:
+        results = execute_gmail_request(service.users().messages().list(userId=user_id, q=query, pageToken=page_token), "messages.list")
+        for message in results.get("messages", []):
+            message_count += 1
+            yield message["id"]
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+
+    print(f"Number of messages found: {message_count}")  # Debugging statement
+    if not message_count:
         print("No new newsletters found.")
-        return []
 
-    emails = []
-    for message in messages:
-        mark_email_as_read(service, "me", message["id"])
-        emails.append(create_email_object(*get_email_content(service, "me", message["id"])))
+def fetch_emails_by_ids(service, message_ids, batch_size=GMAIL_BATCH_SIZE):
+    """Marks the given messages as read and yields them as Email objects, one batch of batch_size at a time."""
+    for chunk in iter_chunks(message_ids, batch_size):
+        mark_emails_as_read(service, "me", chunk)
+
+        emails, failed_ids = get_emails_content_batched(service, "me", chunk, batch_size)
+        if failed_ids:
+            logging.warning(f"{len(failed_ids)} of {len(chunk)} messages could not be retrieved: {list(failed_ids)}")
+
+        yield from emails
+
+def iter_chunks(items, chunk_size):
+    """Yields lists of up to chunk_size items from any iterable."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def get_emails_content_batched(service, user_id, email_ids, batch_size=GMAIL_BATCH_SIZE):
+    """Fetches and decodes multiple emails, grouping the messages.get calls into batch requests.
+
+    The first round of batches reads the headers and the part tree without any part data. The second
+    reads only the data of the chosen body part: through messages.attachments.get when Gmail stores it
+    as an attachment, as format="raw" when the raw message is barely larger than the inline part data,
+    and otherwise as format="full" masked down to the part data.
+
+    Returns the Email objects in the order of email_ids and a dict of the ids that failed with their error.
+    A failing message is reported and skipped without failing the rest of its batch.
+    """
+    messages_by_id = {}
+    body_parts = {}
+    bodies = {}
+    failed_ids = {}
+
+    def record_failure(request_id, action, exception):
+        logging.error(f"Error {action} email {request_id}: {exception}")
+        failed_ids[request_id] = exception
+
+    def handle_part_tree(request_id, response, exception):
+        if exception is not None:
+            record_failure(request_id, "fetching", exception)
+        else:
+            messages_by_id[request_id] = response
+
+    requests_by_id = {
+        email_id: service.users().messages().get(userId=user_id, id=email_id, format="full", fields=PART_TREE_FIELDS)
+        for email_id in email_ids
+    }
+    execute_in_batches(service, requests_by_id, handle_part_tree, batch_size)
+
+    attachment_requests = {}
+    message_requests = {}
+    for email_id, message in messages_by_id.items():
+        part = select_body_part(message["payload"])
+        if part is None:
+            continue
+        body_parts[email_id] = part
+        attachment_id = part.get("body", {}).get("attachmentId")
+        if attachment_id:
+            attachment_requests[email_id] = service.users().messages().attachments().get(userId=user_id, messageId=email_id, id=attachment_id)
+        elif message.get("sizeEstimate", 0) - inline_data_size(message["payload"]) <= RAW_FETCH_SLACK_BYTES:
+            message_requests[email_id] = service.users().messages().get(userId=user_id, id=email_id, format="raw", fields="raw")
+        else:
+            message_requests[email_id] = service.users().messages().get(userId=user_id, id=email_id, format="full", fields=PART_DATA_FIELDS)
+
+    def handle_body_data(request_id, response, exception):
+        if exception is not None:
+            record_failure(request_id, "fetching the body of", exception)
+            return
+        part = body_parts[request_id]
+        try:
+            if "raw" in response:
+                text = decode_part_bytes(get_raw_part_bytes(response["raw"], part.get("partId", "")), get_part_charset(part))
+            elif "payload" in response:
+                text = decode_part_text(find_part(response["payload"], part.get("partId", ""))["body"]["data"], get_part_charset(part))
+            else:  # messages.attachments.get
+                text = decode_part_text(response["data"], get_part_charset(part))
+            bodies[request_id] = part_to_text(part["mimeType"], text)
+        except Exception as e:
+            record_failure(request_id, "decoding", e)
+
+    execute_in_batches(service, attachment_requests, handle_body_data, batch_size, method="messages.attachments.get")
+    execute_in_batches(service, message_requests, handle_body_data, batch_size)
 
-    return emails
+    emails = []
+    for email_id in email_ids:
+        if email_id not in messages_by_id or email_id in failed_ids:
+            continue
+        try:
+            subject, sender_name, sender_email, date = parse_email_headers(messages_by_id[email_id]["payload"])
+            body = clean_body(bodies.get(email_id, "No content found."))
+            emails.append(create_email_object(subject, body, sender_name, sender_email, date, email_id))
+        except Exception as e:
+            record_failure(email_id, "decoding", e)
+    return emails, failed_ids
+
+def execute_in_batches(service, requests_by_id, callback, batch_size=GMAIL_BATCH_SIZE, method="messages.get"):
+    """Executes Gmail API requests as batch HTTP requests of at most batch_size calls each.
+
+    The callback is invoked per request as its response arrives, with the dict key as request_id.
+    Calls that Gmail rejects with a rate-limit error are retried in a follow-up batch after a backoff.
+    """
+    request_items = list(requests_by_id.items())
+    for start in range(0, len(request_items), batch_size):
+        pending = request_items[start:start + batch_size]
+        attempt = 0
+        while pending:
+            rate_limited = []
+            delays = []
+
+            def handle_response(request_id, response, exception):
+                delay = get_rate_limit_delay(exception) if exception is not None else None
+                if delay is not None and attempt < MAX_RETRIES:
+                    rate_limited.append((request_id, requests_by_id[request_id]))
+                    delays.append(delay)
+                    return
+                callback(request_id, response, exception)
+
+            batch = service.new_batch_http_request(callback=handle_response)
+            for request_id, request in pending:
+                batch.add(request, request_id=request_id)
+            call_with_rate_limit("gmail", batch.execute, GMAIL_QUOTA_COSTS[method] * len(pending))
+
+            if rate_limited:
+                wait = backoff_delay(attempt, minimum=max(delays))
+                logging.warning(f"{len(rate_limited)} batched Gmail calls were rate limited. Retrying in {wait:.1f}s.")
+                get_bucket("gmail").pause(wait)
+            pending = rate_limited
+            attempt += 1
 
 def create_email_object(subject, body, sender_name, sender_email, date, gmail_id):
     """Creates an Email object from the Gmail API result."""
@@ -58,38 +310,35 @@ def create_email_object(subject, body, sender_name, sender_email, date, gmail_id
 
 def get_email_content(service, user_id, email_id):
     """Fetches and decodes the email content."""
-    message = service.users().messages().get(userId=user_id, id=email_id, format="full").execute()
+    message = execute_gmail_request(service.users().messages().get(userId=user_id, id=email_id, format="full"))
+    return parse_email_content(message)
+
+def parse_email_content(message):
+    """Decodes a messages.get response (format="full") into the email fields."""
+    email_id = message["id"]
     payload = message["payload"]
+    subject, sender_name, sender_email, date = parse_email_headers(payload)
+
+    extracted_body = extract_email_body(payload)
+
+    cleaned_body = clean_body(extracted_body)
+
+    return subject, cleaned_body, sender_name, sender_email, date, email_id
+
+def parse_email_headers(payload):
+    """Reads the subject, sender name, sender address and date from the top-level headers of a payload."""
     headers = payload.get("headers", [])
     subject = next((h["value"] for h in headers if h["name"] == "Subject"), "No Subject")
     sender = next((h['value'] for h in headers if h['name'] == "From"), "Unknown Sender")
     date = next((h["value"] for h in headers if h["name"] == "Date"), "No Date")
 
     sender_name, sender_email = parseaddr(sender)
-
-    extracted_body = extract_email_body(payload)
-
-    body_without_emojis = remove_emojis(extracted_body)
-
-    cleaned_body = clean_newsletter_body(body_without_emojis)
-
-    return subject, cleaned_body, sender_name, sender_email, date, email_id
+    return subject, sender_name, sender_email, date
 
 def extract_email_body(payload):
-    """Extracts email body, prioritizing text/plain but falling back to text/html."""
-    if "parts" in payload and payload["parts"]:
-        for part in payload["parts"]:
-            if "parts" in part:  # Handle nested parts
-                body = extract_email_body(part)
-                if body:
-                    return body
-            if part["mimeType"] == "text/plain":
-                return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="ignore")
-            elif part["mimeType"] == "text/html":
-                return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8", errors="ignore")
-    elif "body" in payload and "data" in payload["body"]:
-        return base64.urlsafe_b64decode(payload["body"]["data"]).decode("utf-8", errors="ignore")
-    return "No content found."
+    """Extracts the email body, preferring text/plain anywhere in the part tree and converting text/html to plain text."""
+    body = extract_body_text(payload)
+    return body if body is not None else "No content found."
 
 def clean_newsletter_body(text):
     """Cleans up the newsletter content by removing unnecessary elements like links, ads, and tracking info."""
@@ -115,19 +364,23 @@ def clean_newsletter_body(text):
 
 def mark_email_as_read(service, user_id, email_id):
     """Marks an email as read by removing the UNREAD label."""
-    service.users().messages().modify(
+    execute_gmail_request(service.users().messages().modify(
         userId=user_id,
         id=email_id,
         body={'removeLabelIds': ['UNREAD']}
-    ).execute()
+    ), "messages.modify")
+
+def mark_emails_as_read(service, user_id, email_ids):
+    """Marks multiple emails as read with batchModify calls of up to 1000 ids."""
+    batch_modify_labels(service, user_id, email_ids, remove_label_ids=['UNREAD'])
 
 def mark_email_as_unread(service, user_id, email_id):
     """Marks an email as unread by adding the UNREAD label."""
-    service.users().messages().modify(
+    execute_gmail_request(service.users().messages().modify(
         userId=user_id,
         id=email_id,
         body={'addLabelIds': ['UNREAD']}
-    ).execute()
+    ), "messages.modify")
 
 
 def create_label(service, user_id, label_name):
@@ -137,54 +390,46 @@ def create_label(service, user_id, label_name):
         'labelListVisibility': 'labelShow',
         'messageListVisibility': 'show'
     }
-    created_label = service.users().labels().create(userId=user_id, body=label).execute()
+    created_label = execute_gmail_request(service.users().labels().create(userId=user_id, body=label), "labels.create")
     return created_label['id']
 
 def apply_label_to_email(service, user_id, email_id, label_id):
     """Applies a label to an email."""
-    service.users().messages().modify(
+    execute_gmail_request(service.users().messages().modify(
         userId=user_id,
         id=email_id,
         body={'addLabelIds': [label_id]}
-    ).execute()
+    ), "messages.modify")
 
 def apply_label_to_multiple_emails(service, user_id, emails, label_id):
-    """Applies a label to multiple emails."""
+    """Applies a label to multiple emails with batchModify calls of up to 1000 ids."""
     email_ids = [email.gmail_id for email in emails]
-    for email_id in email_ids:
-        apply_label_to_email(service, user_id, email_id, label_id)
+    batch_modify_labels(service, user_id, email_ids, add_label_ids=[label_id])
 
 def rollback_email_status(service, user_id, email):
     """Resets labels if a blog post is not created successfully."""
     email_id = email.gmail_id
-    reset_labels(service, user_id, email_id, ["Label_3076953365604997473", "Label_6126309069161477633"])
-    mark_email_as_unread(service, user_id, email_id)
+    batch_modify_labels(service, user_id, [email_id], add_label_ids=['UNREAD'], remove_label_ids=[PUBLISHED_LABEL_ID, PARSED_LABEL_ID])
     print(f"Email {email_id} rolled back to UNREAD status.")
 
 def rollback_multiple_emails_statuses(service, user_id, emails):
     """Resets labels for multiple emails if blog posts are not created successfully."""
-    for email in emails:
-        reset_labels(service, user_id, email.gmail_id, ["Label_3076953365604997473", "Label_6126309069161477633"])
-        mark_email_as_unread(service, user_id, email.gmail_id)
-        print(f"Email {email.gmail_id} rolled back to READ status.")
-
-# PUBLISHED -> Label_3076953365604997473
-# PARSED -> Label_6126309069161477633
+    email_ids = [email.gmail_id for email in emails]
+    batch_modify_labels(service, user_id, email_ids, add_label_ids=['UNREAD'], remove_label_ids=[PUBLISHED_LABEL_ID, PARSED_LABEL_ID])
+    print(f"{len(email_ids)} emails rolled back to UNREAD status.")
 
 def reset_labels(service, user_id, email_id, label_ids):
     """Removes all labels from an email."""
-    service.users().messages().modify(
+    execute_gmail_request(service.users().messages().modify(
         userId=user_id,
         id=email_id,
         body={'removeLabelIds': label_ids}
-    ).execute()
+    ), "messages.modify")
 
 def reset_process(service, user_id):
     """Resets the process by removing all custom labels from all emails."""
-    results = service.users().messages().list(userId=user_id, q="label:PARSED OR label:PUBLISHED").execute()
-    messages = results.get("messages", [])
-    for message in messages:
-        reset_labels(service, user_id, message["id"], ["Label_3076953365604997473", "Label_6126309069161477633"])
+    message_ids = list(iter_message_ids(service, user_id, "label:PARSED OR label:PUBLISHED"))
+    batch_modify_labels(service, user_id, message_ids, remove_label_ids=[PUBLISHED_LABEL_ID, PARSED_LABEL_ID])
 
 def remove_emojis(text):
     emoji_pattern = re.compile(
@@ -0,0 +1,70 @@
+import re
+from html.parser import HTMLParser
+
+# Tags whose content never reaches the reader
+SKIPPED_TAGS = {"head", "script", "style", "title", "noscript", "template", "svg"}
+# Tags that start a new line of text
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "footer", "h1", "h2", "h3",
+    "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table", "tr", "ul",
+}
+HIDDEN_STYLE_REGEX = re.compile(r'display\s*:\s*none|visibility\s*:\s*hidden|max-height\s*:\s*0', re.IGNORECASE)
+INVISIBLE_CHARACTERS_REGEX = re.compile('[\u200b\u200c\u200d\u034f\u00ad\ufeff]+')  # Zero-width fillers used in preheaders
+WHITESPACE_REGEX = re.compile('[ \t\r\f\v\u00a0]+')
+NEWLINES_REGEX = re.compile(r'\s*\n\s*')
+
+class HtmlToTextConverter(HTMLParser):
+    """Streaming HTML-to-text converter: feed() markup in chunks, then close() and read text().
+
+    Drops markup, scripts, styles and hidden preheader blocks, keeps one line per block element
+    and collapses whitespace, so the text is as compact as the plain-text part of a newsletter.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._pieces = []
+        self._skipped_tag = None
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._skipped_tag:
+            if tag == self._skipped_tag:
+                self._skip_depth += 1
+            return
+        if tag in SKIPPED_TAGS or HIDDEN_STYLE_REGEX.search(dict(attrs).get("style") or ""):
+            if tag not in ("br", "hr", "img", "meta", "link", "input"):  # Void elements have no end tag to wait for
+                self._skipped_tag = tag
+                self._skip_depth = 1
+            return
+        if tag in BLOCK_TAGS:
+            self._pieces.append("\n")
+        if tag in ("td", "th"):
+            self._pieces.append(" ")
+
+    def handle_endtag(self, tag):
+        if self._skipped_tag:
+            if tag == self._skipped_tag:
+                self._skip_depth -= 1
+                if self._skip_depth == 0:
+                    self._skipped_tag = None
+            return
+        if tag in BLOCK_TAGS:
+            self._pieces.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipped_tag:
+            self._pieces.append(data)
+
+    def text(self):
+        """Returns the text collected so far with whitespace collapsed."""
+        text = INVISIBLE_CHARACTERS_REGEX.sub("", "".join(self._pieces))
+        text = WHITESPACE_REGEX.sub(" ", text)
+        return NEWLINES_REGEX.sub("\n", text).strip()
+
+def html_to_text(html, chunk_size=64 * 1024):
+    """Converts an HTML document to compact plain text, feeding the parser chunk by chunk."""
+    converter = HtmlToTextConverter()
+    for start in range(0, len(html), chunk_size):
+        converter.feed(html[start:start + chunk_size])
+    converter.close()
+    return converter.text()
@@ -0,0 +1,69 @@
+import logging
+
+from rate_limiting.rate_limiter import execute_gmail_request
+
+# users.messages.batchModify accepts at most 1000 message ids per call
+BATCH_MODIFY_MAX_IDS = 1000
+
+def batch_modify_labels(service, user_id, email_ids, add_label_ids=None, remove_label_ids=None):
+    """Adds and removes labels on many emails with users.messages.batchModify, in chunks of up to 1000 ids."""
+    email_ids = list(dict.fromkeys(email_ids))  # Drop duplicates, keep order
+    body = {}
+    if add_label_ids:
+        body["addLabelIds"] = list(add_label_ids)
+    if remove_label_ids:
+        body["removeLabelIds"] = list(remove_label_ids)
+    if not email_ids or not body:
+        return 0
+
+    calls = 0
+    for start in range(0, len(email_ids), BATCH_MODIFY_MAX_IDS):
+        chunk = email_ids[start:start + BATCH_MODIFY_MAX_IDS]
+        execute_gmail_request(service.users().messages().batchModify(userId=user_id, body={"ids": chunk, **body}), "messages.batchModify")
+        calls += 1
+    return calls
+
+class LabelMutations:
+    """Collects label changes for a run and flushes them with as few batchModify calls as possible.
+
+    Changes are tracked per email, so a later change wins over an earlier one
+    (e.g. adding PARSED and then rolling it back leaves only the removal).
+    Emails that end up with the same label changes are flushed together.
+    """
+
+    def __init__(self, user_id="me"):
+        self.user_id = user_id
+        self._pending = {}  # gmail_id -> (labels to add, labels to remove)
+
+    def add_labels(self, email_ids, label_ids):
+        """Queues label_ids to be added to the given emails."""
+        for email_id in email_ids:
+            to_add, to_remove = self._pending.setdefault(email_id, (set(), set()))
+            to_add.update(label_ids)
+            to_remove.difference_update(label_ids)
+
+    def remove_labels(self, email_ids, label_ids):
+        """Queues label_ids to be removed from the given emails."""
+        for email_id in email_ids:
+            to_add, to_remove = self._pending.setdefault(email_id, (set(), set()))
+            to_remove.update(label_ids)
+            to_add.difference_update(label_ids)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self, service):
+        """Sends all queued changes and returns the number of batchModify calls made."""
+        groups = {}
+        for email_id, (to_add, to_remove) in self._pending.items():
+            key = (frozenset(to_add), frozenset(to_remove))
+            groups.setdefault(key, []).append(email_id)
+
+        calls = 0
+        for (to_add, to_remove), email_ids in groups.items():
+            calls += batch_modify_labels(service, self.user_id, email_ids, sorted(to_add), sorted(to_remove))
+            for email_id in email_ids:
+                del self._pending[email_id]
+
+        logging.info(f"Flushed label changes for {sum(len(ids) for ids in groups.values())} emails in {calls} batchModify call(s).")
+        return calls
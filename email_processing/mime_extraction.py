@@ -0,0 +1,130 @@
+import base64
+import email
+import email.policy
+import os
+import re
+
+from email_processing.html_to_text import html_to_text
+
+# Text parts larger than this are almost always embedded data rather than newsletter text
+MAX_TEXT_PART_BYTES = int(os.getenv("MAX_TEXT_PART_BYTES", str(2 * 1024 * 1024)))
+
+CHARSET_REGEX = re.compile(r'charset="?([\w.:-]+)"?', re.IGNORECASE)
+
+# Newsletters rarely nest parts more than four levels deep (mixed > related > alternative > text)
+PART_TREE_DEPTH = int(os.getenv("GMAIL_PART_TREE_DEPTH", "6"))
+
+def get_part_header(part, name):
+    """Returns the value of a header of a Gmail message part, or an empty string."""
+    name = name.lower()
+    return next((h["value"] for h in part.get("headers", []) if h["name"].lower() == name), "")
+
+def is_attachment(part):
+    """True for attachments and inline files (images etc.), which never hold the newsletter text."""
+    if part.get("filename"):
+        return True
+    disposition = get_part_header(part, "Content-Disposition").lower()
+    return disposition.startswith("attachment") or (disposition.startswith("inline") and "filename" in disposition)
+
+def iter_text_parts(payload):
+    """Walks the whole Gmail part tree depth-first and yields the text/plain and text/html leaf parts.
+
+    Attachments, inline images and other non-text parts are skipped by type, and text parts
+    above MAX_TEXT_PART_BYTES are skipped by size.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        mime_type = part.get("mimeType", "").lower()
+        if part.get("parts"):
+            if mime_type != "message/rfc822":  # Forwarded messages are attachments too
+                stack.extend(reversed(part["parts"]))
+            continue
+        if mime_type not in ("text/plain", "text/html") or is_attachment(part):
+            continue
+        if part.get("body", {}).get("size", 0) > MAX_TEXT_PART_BYTES:
+            continue
+        yield part
+
+def select_body_part(payload):
+    """Picks the part to read the body from: the first non-empty text/plain part anywhere in the tree,
+    otherwise the first non-empty text/html part. Only needs the part tree, not the part data.
+    """
+    html_part = None
+    for part in iter_text_parts(payload):
+        if not part.get("body", {}).get("size", 0) and not part.get("body", {}).get("data"):
+            continue
+        if part["mimeType"].lower() == "text/plain":
+            return part
+        if html_part is None:
+            html_part = part
+    return html_part
+
+def get_part_charset(part):
+    """Returns the charset declared in the part's Content-Type header, defaulting to UTF-8."""
+    match = CHARSET_REGEX.search(get_part_header(part, "Content-Type"))
+    return match.group(1) if match else "utf-8"
+
+def decode_part_text(data, charset="utf-8"):
+    """Decodes base64url part data into text with the given charset."""
+    return decode_part_bytes(base64.urlsafe_b64decode(data), charset)
+
+def part_to_text(mime_type, text):
+    """Returns the readable text of a part, converting HTML to compact plain text."""
+    if mime_type.lower() == "text/html":
+        return html_to_text(text)
+    return text
+
+def extract_body_text(payload):
+    """Extracts the readable body text from a Gmail message payload (format="full"), or None."""
+    part = select_body_part(payload)
+    if part is None or not part.get("body", {}).get("data"):
+        return None
+    return part_to_text(part["mimeType"], decode_part_text(part["body"]["data"], get_part_charset(part)))
+
+def build_part_fields(part_fields, depth=PART_TREE_DEPTH):
+    """Builds a partial-response mask selecting part_fields on the payload and its parts down to depth levels."""
+    fields = part_fields
+    for _ in range(depth):
+        fields = f"{part_fields},parts({fields})"
+    return f"payload({fields})"
+
+def find_part(payload, part_id):
+    """Returns the part with the given Gmail partId from a part tree, or None."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("partId", "") == part_id:
+            return part
+        stack.extend(part.get("parts", []))
+    return None
+
+def inline_data_size(payload):
+    """Sums the sizes of the leaf parts whose data Gmail returns inline rather than by attachmentId."""
+    stack = [payload]
+    total = 0
+    while stack:
+        part = stack.pop()
+        if part.get("parts"):
+            stack.extend(part["parts"])
+        elif not part.get("body", {}).get("attachmentId"):
+            total += part.get("body", {}).get("size", 0)
+    return total
+
+def get_raw_part_bytes(raw, part_id):
+    """Parses a format="raw" message with the stdlib email parser and returns the decoded bytes of a part.
+
+    Gmail partIds are the dotted child indexes of the part ("" for a single-part message, "1.0" for the
+    first child of the second part), so the part is found by walking the parsed MIME tree.
+    """
+    part = email.message_from_bytes(base64.urlsafe_b64decode(raw), policy=email.policy.compat32)
+    for index in filter(None, part_id.split(".")):
+        part = part.get_payload()[int(index)]
+    return part.get_payload(decode=True) or b""
+
+def decode_part_bytes(raw, charset="utf-8"):
+    """Decodes the bytes of a part with the given charset, falling back to UTF-8 for unknown charsets."""
+    try:
+        return raw.decode(charset, errors="ignore")
+    except LookupError:  # Unknown charset name
+        return raw.decode("utf-8", errors="ignore")
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Index, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from database.base import Base
@@ -9,6 +9,9 @@ from database.base import Base
 @dataclass
 class BlogPostMetadata(Base):
     __tablename__ = 'blog_post_metadata'
+    __table_args__ = (
+        Index('ux_blog_post_metadata_slug', 'slug', unique=True),
+    )
 
     id: int = Column(Integer, primary_key=True, autoincrement=True)
     title: str = Column(String, nullable=False)
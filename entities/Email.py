@@ -1,21 +1,54 @@
 from dataclasses import dataclass
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, DateTime, func, select
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 from database.base import Base
+from database.types import CompressedText
+from entities.Email_body import EmailBody
 
 @dataclass
 class Email(Base):
     __tablename__ = 'emails'
+    __table_args__ = (
+        Index('ix_emails_date', 'date'),
+        Index('ix_emails_published_date', 'published', 'date'),  # Unpublished emails of a period
+        Index('ix_emails_sender_email_date', 'sender_email', 'date'),  # Emails of one newsletter over time
+        Index('ix_emails_body_hash', 'body_hash'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     sender_name = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow, nullable=False)
     subject = Column(String, nullable=False)
-    body = Column(Text, nullable=False)
+    inline_body = Column('body', CompressedText, nullable=False)  # Stored zlib/zstd-compressed, empty once the body is in email_bodies
     sender_email = Column(String, nullable=False)
     gmail_id = Column(String, unique=True, nullable=False)
     published = Column(Integer, nullable=False)
+    body_hash = Column(String(64), ForeignKey('email_bodies.body_hash'), nullable=True)
+
+    # Shared body row, see database/body_store.py
+    stored_body = relationship(EmailBody, lazy='joined')
+
+    @hybrid_property
+    def body(self):
+        return self.stored_body.body if self.stored_body is not None else self.inline_body
+
+    @body.setter
+    def body(self, value):
+        self.inline_body = value
+        self.stored_body = None
+
+    @body.expression
+    def body(cls):
+        shared_body = select(EmailBody.body).where(EmailBody.body_hash == cls.body_hash).scalar_subquery()
+        return func.coalesce(shared_body, cls.inline_body, type_=CompressedText)
+
+    def use_stored_body(self, stored_body):
+        """Moves the body to a shared email_bodies row and empties the inline column."""
+        self.stored_body = stored_body
+        self.inline_body = ""
 
     def __repr__(self):
         return f"Email(sender_name={self.sender_name}, date={self.date}, subject={self.subject}, sender_email={self.sender_email})"
@@ -0,0 +1,19 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime
+from database.base import Base
+from database.types import CompressedText
+
+
+@dataclass
+class EmailBody(Base):
+    __tablename__ = 'email_bodies'
+
+    body_hash = Column(String(64), primary_key=True)  # sha256 of the normalised body, see database/body_store.py
+    body = Column(CompressedText, nullable=False)  # The body as first received
+    size = Column(Integer, nullable=False)  # Length of the body in characters
+    duplicate_hits = Column(Integer, default=0, nullable=False)  # Later emails that arrived with the same body
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"EmailBody(body_hash={self.body_hash}, size={self.size}, duplicate_hits={self.duplicate_hits})"
@@ -0,0 +1,25 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import Column, Index, Integer, String, DateTime
+from database.base import Base
+from database.types import CompressedText
+
+
+@dataclass
+class LlmResponse(Base):
+    __tablename__ = 'llm_responses'
+    __table_args__ = (
+        Index('ix_llm_responses_last_used_at', 'last_used_at'),
+    )
+
+    cache_key = Column(String(64), primary_key=True)  # sha256 of the request parameters, see database/response_cache.py
+    model = Column(String, nullable=False)
+    response = Column(CompressedText, nullable=False)  # The ChatCompletion as JSON
+    size = Column(Integer, nullable=False)  # Size of the JSON in bytes, before compression
+    total_tokens = Column(Integer, default=0, nullable=False)  # Tokens the original request used
+    hit_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    last_used_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"LlmResponse(cache_key={self.cache_key}, model={self.model}, hit_count={self.hit_count})"
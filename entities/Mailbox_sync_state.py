@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime
+from database.base import Base
+
+
+@dataclass
+class MailboxSyncState(Base):
+    __tablename__ = 'mailbox_sync_state'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sync_key = Column(String, unique=True, nullable=False)  # One checkpoint per query, e.g. per subject
+    history_id = Column(String, nullable=False)  # Last Gmail historyId that was fully synced
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"MailboxSyncState(sync_key={self.sync_key}, history_id={self.history_id})"
@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import Column, Index, Integer, String, DateTime
+from database.base import Base
+from database.types import CompressedText
+
+
+@dataclass
+class OpenAIBatchJob(Base):
+    __tablename__ = 'openai_batch_jobs'
+    __table_args__ = (
+        Index('ix_openai_batch_jobs_collected_at', 'collected_at'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, unique=True, nullable=False)  # OpenAI batch id, e.g. batch_abc123
+    input_file_id = Column(String, nullable=False)
+    output_file_id = Column(String, nullable=True)
+    error_file_id = Column(String, nullable=True)
+    status = Column(String, nullable=False)  # Last status reported by the Batch API
+    edition = Column(String, nullable=False)  # Sunday or Wednesday
+    manifest = Column(CompressedText, nullable=False)  # JSON: custom_id -> subject, Gmail IDs, prompt and, once stored, blogpost_id
+    request_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    collected_at = Column(DateTime, nullable=True)  # Set once the results are stored, the job is then finished
+
+    def __repr__(self):
+        return f"OpenAIBatchJob(batch_id={self.batch_id}, status={self.status}, edition={self.edition})"
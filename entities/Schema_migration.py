@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime
+from database.base import Base
+
+
+@dataclass
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"SchemaMigration(version={self.version}, name={self.name})"
@@ -4,6 +4,8 @@ import subprocess
 import time
 import requests
 
+from rate_limiting.rate_limiter import backoff_delay, call_with_rate_limit
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # Detect GitHub Actions environment
@@ -181,7 +183,7 @@ def check_existing_pr():
         api_url = f"https://api.github.com/repos/{OWNER}/{REPO}/pulls?state=open"
         headers = {"Authorization": f"token {GH_TOKEN}", "Accept": "application/vnd.github.v3+json"}
 
-        response = requests.get(api_url, headers=headers)
+        response = call_with_rate_limit("github", lambda: requests.get(api_url, headers=headers))
         if response.status_code != 200:
             logging.error(f"Failed to check existing PRs: {response.json()}")
             return None
@@ -211,7 +213,7 @@ def create_pull_request():
             "body": "This PR contains all weekly blogpost updates."
         }
 
-        response = requests.post(api_url, json=payload, headers=headers)
+        response = call_with_rate_limit("github", lambda: requests.post(api_url, json=payload, headers=headers))
         if response.status_code == 201:
             pr_number = response.json().get("number")
             logging.info(f"Pull request created successfully! PR number: {pr_number}")
@@ -244,10 +246,6 @@ def commit_and_push_all(blogposts):
     except Exception as e:
         logging.error(f"Error during commit and push process: {e}")
         return None
-    
-import time
-
-import time
 
 def merge_pull_request(pr_number):
     """Merges an open PR (`develop` → `master`)."""
@@ -266,7 +264,7 @@ def merge_pull_request(pr_number):
     # Wait for GitHub to calculate mergeability
     attempts = 0
     while attempts < 10:
-        pr_response = requests.get(pr_url, headers=headers)
+        pr_response = call_with_rate_limit("github", lambda: requests.get(pr_url, headers=headers))
         pr_data = pr_response.json()
 
         mergeable_state = pr_data.get("mergeable_state", "unknown")
@@ -291,13 +289,13 @@ def merge_pull_request(pr_number):
             return True
         else:
             logging.info("Waiting for GitHub to determine mergeability...")
-            time.sleep(10)
+            time.sleep(backoff_delay(attempts, minimum=1, cap=15))  # Poll quickly at first, then back off
             attempts += 1
 
     # If mergeable, merge via API
     merge_url = f"https://api.github.com/repos/{OWNER}/{REPO}/pulls/{pr_number}/merge"
     merge_payload = {"commit_message": f"Auto-merging PR #{pr_number}"}
-    merge_response = requests.put(merge_url, json=merge_payload, headers=headers)
+    merge_response = call_with_rate_limit("github", lambda: requests.put(merge_url, json=merge_payload, headers=headers))
 
     if merge_response.status_code == 200:
         logging.info(f"Pull request #{pr_number} merged successfully!")
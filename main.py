@@ -1,21 +1,24 @@
 import argparse
+import asyncio
 from datetime import datetime
 import email
 import sys
-import time
 from dotenv import load_dotenv
 import logging
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from auth.gmail_auth import authenticate_gmail 
 from database import db_operations
-from email_processing.gmail_interactions import apply_label_to_multiple_emails, fetch_sunday_emails, fetch_wednesday_emails, rollback_email_status, rollback_multiple_emails_statuses
-from database.db_operations import initialize_database, insert_email, check_if_email_exists_by_gmail_id
+from email_processing.gmail_interactions import PARSED_LABEL_ID, PUBLISHED_LABEL_ID, SUNDAY_WINDOW_DAYS, WEDNESDAY_WINDOW_DAYS, fetch_emails_incremental, fetch_sunday_emails, fetch_wednesday_emails, iter_chunks
+from email_processing.label_mutations import LabelMutations
+from database.db_operations import initialize_database, ingest_emails, get_emails_by_gmail_ids, unit_of_work
+from database.response_cache import cache_stats
 from entities.Email import Email
 from enums.blogpost_subject import BlogPostSubject
 from enums.gmail_labels import GmailLabels
 from enums.newsletters import Newsletters
-from blog.blogpost_creator import create_blogpost, generate_markdown_file
+from blog.blogpost_creator import create_blogpost, create_blogpost_async, generate_markdown_file
+from blog.batch_submission import generate_blogposts_in_batch
 from git_processing.git_operations import commit_and_push_all, merge_pull_request
 
 # Configure logging
@@ -30,21 +33,39 @@ logging.getLogger().setLevel(logging.INFO)
 
 # Supported subjects
 SUBJECTS = ["AI", "TECH", "SCIENCE"]
+# Fetched emails are stored in one transaction per this many emails
+INGEST_BATCH_SIZE = 500
 blogposts_to_commit = []  # List to track blog posts that need committing
 
 def get_active_newsletters(subject):
     """Fetch active newsletters for a given subject."""
     return [newsletter.email for newsletter in Newsletters if newsletter.active and newsletter.subject == subject]
 
-def fetch_emails_for_today(service, active_newsletters, today):
-    """Determine the day and fetch emails accordingly."""
+def get_sender_subject_index(subjects):
+    """Map the sender address of every active newsletter of the given subjects to its subject."""
+    return {
+        newsletter.email.lower(): newsletter.subject
+        for newsletter in Newsletters
+        if newsletter.active and newsletter.subject in subjects
+    }
+
+def fetch_emails_for_today(service, active_newsletters, today, sync_key=None, pending_checkpoints=None):
+    """Determine the day and return a stream of fetched emails accordingly.
+
+    With a sync_key, only messages added since that key's last history checkpoint are fetched,
+    and the new checkpoint is put in pending_checkpoints.
+    """
 
     try:
         if today == "Sunday":
             logging.info("Running Sunday email fetch...")
+            if sync_key:
+                return fetch_emails_incremental(service, active_newsletters, sync_key, SUNDAY_WINDOW_DAYS, pending_checkpoints)
             return fetch_sunday_emails(service, active_newsletters)
         elif today == "Wednesday":
             logging.info("Running Wednesday email fetch...")
+            if sync_key:
+                return fetch_emails_incremental(service, active_newsletters, sync_key, WEDNESDAY_WINDOW_DAYS, pending_checkpoints)
             return fetch_wednesday_emails(service, active_newsletters)
         else:
             logging.warning("Script executed on an unintended day. Skipping email fetch.")
@@ -66,15 +87,13 @@ def parse_email_date(date_string):
         return None  # Return None so we can handle it gracefully
 
 def process_emails(emails):
-    """Process and store emails in the database."""
-    if not emails:
-        logging.info("No new emails fetched. Skipping processing.")
-        return
-    
-    for email in emails:
-        try:
-            if not check_if_email_exists_by_gmail_id(email.gmail_id):
-                email_object = Email(
+    """Store a stream of fetched emails in the database, one transaction per INGEST_BATCH_SIZE emails,
+    and return their Gmail IDs."""
+    gmail_ids = []
+    try:
+        for chunk in iter_chunks(emails, INGEST_BATCH_SIZE):
+            email_objects = [
+                Email(
                     sender_name=email.sender_name,
                     date=parse_email_date(email.date),
                     subject=email.subject,
@@ -83,23 +102,82 @@ def process_emails(emails):
                     gmail_id=email.gmail_id,
                     published=False
                 )
-                insert_email(email_object)
-                logging.info(f"Inserted email from {email.sender_name} with subject '{email.subject}' into the database.")
-            else:
-                logging.info(f"Email from {email.sender_name} with subject '{email.subject}' already exists in the database.")
-        except Exception as e:
-            logging.error(f"Error processing email {email.gmail_id}: {e}")
+                for email in chunk
+            ]
+            try:
+                inserted, skipped, duplicate_bodies = ingest_emails(email_objects)
+                logging.info(f"Inserted {inserted} emails into the database ({duplicate_bodies} with an already stored body), {skipped} already existed.")
+                gmail_ids.extend(email.gmail_id for email in chunk)
+            except Exception as e:
+                logging.error(f"Error storing {len(chunk)} emails: {e}")
+    except HttpError as e:
+        logging.error(f"Gmail API error while fetching emails: {e}")
+    except Exception as e:
+        logging.error(f"Unexpected error while fetching emails: {e}")
+
+    if not gmail_ids:
+        logging.info("No new emails fetched. Skipping processing.")
+    return gmail_ids
 
-def generate_blogpost(emails, subject, today):
-    """Generate a blog post from emails and publish it."""
+def ingest_emails_in_single_pass(service, subjects, today, pending_checkpoints, incremental=False):
+    """Fetch the newsletters of all subjects with one mailbox query and route the stored emails to their subject.
+
+    Returns a dict of subject -> Gmail IDs of the stored emails.
+    """
+    sender_index = get_sender_subject_index(subjects)
+    gmail_ids_by_subject = {subject: [] for subject in subjects}
+
+    if not sender_index:
+        logging.info("No active newsletters added for any subject. Skipping email fetch.")
+        return gmail_ids_by_subject
+
+    subject_by_gmail_id = {}
+
+    def route(emails):
+        for email in emails:
+            subject = sender_index.get(email.sender_email.lower())
+            if subject is None:
+                logging.warning(f"Email {email.gmail_id} from {email.sender_email} matches no active newsletter. Skipping.")
+                continue
+            subject_by_gmail_id[email.gmail_id] = subject
+            yield email
+
+    logging.info(f"Fetching newsletters for {', '.join(subject.name for subject in subjects)} in a single pass...")
+    fetched_emails = fetch_emails_for_today(service, list(sender_index), today, "ALL" if incremental else None, pending_checkpoints)
+    for gmail_id in process_emails(route(fetched_emails)):
+        gmail_ids_by_subject[subject_by_gmail_id[gmail_id]].append(gmail_id)
+
+    return gmail_ids_by_subject
+
+def ingest_emails_per_subject(service, subjects, today, pending_checkpoints, incremental=False):
+    """Fetch and store the newsletters of each subject with a separate mailbox query per subject.
+
+    Returns a dict of subject -> Gmail IDs of the stored emails.
+    """
+    gmail_ids_by_subject = {}
+    for subject in subjects:
+        logging.info(f"Fetching {subject} newsletters...")
+        active_newsletters = get_active_newsletters(subject)
+
+        if not active_newsletters:
+            logging.info(f"No active newsletters added for {subject} or they're not active (bool isn't True). Skipping to next subject.")
+            continue
+
+        fetched_emails = fetch_emails_for_today(service, active_newsletters, today, subject.name if incremental else None, pending_checkpoints)
+        gmail_ids_by_subject[subject] = process_emails(fetched_emails)
+
+    return gmail_ids_by_subject
+
+def generate_blogpost(emails, subject, today, session=None):
+    """Generate a blog post from emails and publish it, inside the given unit-of-work session."""
     if not emails:
         logging.info(f"No emails found for {subject}. Skipping blog post generation.")
         return
     
     try:
-        blogpost = create_blogpost(emails, subject, today)
+        blogpost = create_blogpost(emails, subject, today, session)
         blogpost_dto = generate_markdown_file(blogpost)
-        updated_blogpost = db_operations.update_blogpost(blogpost_dto.id, blogpost_dto)
+        updated_blogpost = db_operations.update_blogpost(blogpost_dto.id, blogpost_dto, session=session)
 
         logging.info(f"Generated blog post for {subject}.")
         return updated_blogpost  # Add to list for later Git committing
@@ -108,12 +186,126 @@ def generate_blogpost(emails, subject, today):
         logging.error(f"Error during blog post generation/publishing for {subject}: {e}")
         return None
 
+async def generate_blogpost_async(emails, subject, today, session=None):
+    """generate_blogpost for the concurrent mode, the blocking steps run in worker threads."""
+    if not emails:
+        logging.info(f"No emails found for {subject}. Skipping blog post generation.")
+        return
+
+    try:
+        blogpost = await create_blogpost_async(emails, subject, today, session)
+        blogpost_dto = await asyncio.to_thread(generate_markdown_file, blogpost)
+        updated_blogpost = await asyncio.to_thread(db_operations.update_blogpost, blogpost_dto.id, blogpost_dto, session=session)
+
+        logging.info(f"Generated blog post for {subject}.")
+        return updated_blogpost
+
+    except Exception as e:
+        logging.error(f"Error during blog post generation/publishing for {subject}: {e}")
+        return None
+
+def generate_subject_blogpost(subject, gmail_ids, today):
+    """Generate the blog post of one subject in its own unit of work. Returns the Gmail IDs of its emails and the blog post.
+    A failure only affects this subject."""
+    logging.info(f"Processing {subject} newsletters...")
+    # One unit of work per subject: the blog post is only stored if every stage succeeds
+    try:
+        with unit_of_work() as session:
+            emails = get_emails_by_gmail_ids(gmail_ids, session=session)
+            email_ids = [email.gmail_id for email in emails]
+            blogpost = generate_blogpost(emails, subject, today, session)
+            if not blogpost:
+                session.rollback()
+    except Exception as e:
+        logging.error(f"Error while processing {subject} newsletters: {e}")
+        return list(gmail_ids), None
+    return email_ids, blogpost
+
+async def generate_subject_blogpost_async(subject, gmail_ids, today, semaphore):
+    """generate_subject_blogpost for the concurrent mode. A failure only affects this subject."""
+    async with semaphore:
+        logging.info(f"Processing {subject} newsletters...")
+        try:
+            with unit_of_work() as session:
+                emails = await asyncio.to_thread(get_emails_by_gmail_ids, gmail_ids, session=session)
+                email_ids = [email.gmail_id for email in emails]
+                blogpost = await generate_blogpost_async(emails, subject, today, session)
+                if not blogpost:
+                    session.rollback()
+        except Exception as e:
+            logging.error(f"Error while processing {subject} newsletters: {e}")
+            return list(gmail_ids), None
+    return email_ids, blogpost
+
+async def generate_blogposts_concurrently(gmail_ids_by_subject, subjects, today, concurrency):
+    """Generate the blog posts of the subjects at the same time, at most `concurrency` at once.
+    Returns (subject, (email IDs, blog post)) pairs in the order of subjects."""
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(
+        generate_subject_blogpost_async(subject, gmail_ids_by_subject[subject], today, semaphore) for subject in subjects
+    ))
+    return list(zip(subjects, results))
+
+def drop_published_emails(gmail_ids_by_subject):
+    """Leave out the emails that are already in a pushed blog post. A checkpoint that was held back for a
+    failed subject fetches the emails of every subject it covers again, and only the failed ones need a post."""
+    published = db_operations.get_published_gmail_ids(gmail_id for gmail_ids in gmail_ids_by_subject.values() for gmail_id in gmail_ids)
+    if not published:
+        return gmail_ids_by_subject
+    for subject, gmail_ids in gmail_ids_by_subject.items():
+        remaining = [gmail_id for gmail_id in gmail_ids if gmail_id not in published]
+        if len(remaining) < len(gmail_ids):
+            logging.info(f"Skipping {len(gmail_ids) - len(remaining)} {subject} emails that are already in a published blog post.")
+        gmail_ids_by_subject[subject] = remaining
+    return gmail_ids_by_subject
+
+def save_pending_checkpoints(pending_checkpoints, subjects, unfinished_subjects):
+    """Save the history checkpoints of this run's incremental fetch, except those that cover a subject
+    without a finished blog post: the next incremental run then fetches that subject's emails again."""
+    for sync_key, history_id in pending_checkpoints.items():
+        covered_subjects = subjects if sync_key == "ALL" else [BlogPostSubject[sync_key]]
+        unfinished = [subject for subject in covered_subjects if subject in unfinished_subjects]
+        if unfinished:
+            logging.warning(f"Not advancing the history checkpoint {sync_key}: {', '.join(subject.name for subject in unfinished)} has no finished blog post.")
+            continue
+        db_operations.save_history_checkpoint(sync_key, history_id)
+
+def print_search_results(query, target, limit):
+    """Print the best full-text search matches for query."""
+    if target == "emails":
+        for email, score in db_operations.search_emails(query, limit):
+            print(f"{score:9.3g}  {email.date:%Y-%m-%d}  {email.sender_name:<25.25}  {email.subject}")
+    else:
+        for blogpost, score in db_operations.search_blogposts(query, limit):
+            title = blogpost.blogpost_metadata.title if blogpost.blogpost_metadata else ""
+            print(f"{score:9.3g}  {blogpost.created_at:%Y-%m-%d}  {blogpost.blogpost_subject:<8}  {title}")
+
 def main():
     """Main entry point for the script."""
     parser = argparse.ArgumentParser(description="Run the AI News Summary script.")
     parser.add_argument("--day", type=str, choices=["Sunday", "Wednesday"], help="Manually specify the day for testing.")
+    parser.add_argument("--incremental", action="store_true", help="Only fetch emails added since the last run, using Gmail history checkpoints.")
+    parser.add_argument("--per-subject-fetch", action="store_true", help="Query the mailbox separately for each subject instead of once for all subjects.")
+    parser.add_argument("--search", type=str, help="Search the stored newsletters or blog posts instead of running the pipeline.")
+    parser.add_argument("--search-in", choices=["emails", "blogposts"], default="emails", help="What --search looks in.")
+    parser.add_argument("--limit", type=int, default=20, help="Maximum number of search results.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Generate the blog posts of up to this many subjects at the same time, using AsyncOpenAI.")
+    parser.add_argument("--batch", action="store_true", help="Send the blog post requests through the OpenAI Batch API and store the results of finished batches.")
+    parser.add_argument("--batch-wait", type=float, default=0, help="With --batch, wait up to this many seconds for the submitted batch instead of collecting it in a later run.")
+    parser.add_argument("--rebuild-search-index", action="store_true", help="Rebuild the full-text search index from the stored rows and exit.")
     args = parser.parse_args()
-    emails_to_update_labels = []  # List to track emails for label updates
+
+    if args.rebuild_search_index:
+        email_count, blogpost_count = db_operations.rebuild_search_index()
+        logging.info(f"Search index rebuilt: {email_count} emails and {blogpost_count} blog posts.")
+        return
+    if args.search:
+        print_search_results(args.search, args.search_in, args.limit)
+        return
+    gmail_ids_to_publish = []  # Gmail IDs of the emails whose blog posts are pushed
+    pending_checkpoints = {}  # History checkpoints of the incremental fetch, saved once the blog posts succeeded
+    label_mutations = LabelMutations("me")  # Label changes are collected for the whole run and flushed at the end
+    service = None
 
     # Use the argument if provided, otherwise use today's actual day
     today = args.day if args.day else datetime.today().strftime('%A')
@@ -122,52 +314,76 @@ def main():
         creds = authenticate_gmail()
         service = build("gmail", "v1", credentials=creds)
 
-        # Step 2: Fetch active newsletters and generate blog posts for multiple subjects
-        for subject in SUBJECTS:
-            emails = []  # Reset emails for each subject
-            logging.info(f"Processing {subject} newsletters...")
-            subject = BlogPostSubject[subject]
-            active_newsletters = get_active_newsletters(subject)
-
-            if not active_newsletters:
-                logging.info(f"No active newsletters added for {subject} or they're not active (bool isn't True). Skipping to next subject.")
-                continue  
-
-            emails = fetch_emails_for_today(service, active_newsletters, today)
+        # Step 2: Fetch and store the newsletters of all subjects
+        subjects = [BlogPostSubject[subject] for subject in SUBJECTS]
+        if args.per_subject_fetch:
+            gmail_ids_by_subject = ingest_emails_per_subject(service, subjects, today, pending_checkpoints, args.incremental)
+        else:
+            gmail_ids_by_subject = ingest_emails_in_single_pass(service, subjects, today, pending_checkpoints, args.incremental)
+        if args.incremental:
+            gmail_ids_by_subject = drop_published_emails(gmail_ids_by_subject)
 
-            if not emails:
+        # Step 3: Generate blog posts for multiple subjects
+        subjects_with_emails = []
+        for subject in subjects:
+            if not gmail_ids_by_subject.get(subject):
                 logging.info(f"No emails found for {subject}. Skipping to next subject.")
                 continue
+            subjects_with_emails.append(subject)
 
-            process_emails(emails)
-            blogpost = generate_blogpost(emails, subject, today)
+        if args.batch:
+            # Blog posts of batches submitted by earlier runs are published with this run's
+            results = generate_blogposts_in_batch(gmail_ids_by_subject, subjects_with_emails, today, args.batch_wait)
+        elif args.concurrency > 1:
+            results = asyncio.run(generate_blogposts_concurrently(gmail_ids_by_subject, subjects_with_emails, today, args.concurrency))
+        else:
+            results = ((subject, generate_subject_blogpost(subject, gmail_ids_by_subject[subject], today)) for subject in subjects_with_emails)
+
+        for subject, (email_ids, blogpost) in results:
             if blogpost: 
-                apply_label_to_multiple_emails(service, "me", emails, "Label_6126309069161477633") 
-                emails_to_update_labels.extend(emails)  # Add emails to the list for label updates
+                label_mutations.add_labels(email_ids, [PARSED_LABEL_ID])
+                gmail_ids_to_publish.extend(email_ids)  # Add emails to the list for label updates
                 blogposts_to_commit.append(blogpost)
             else:
                 logging.warning(f"Blog post generation failed for {subject}. Resetting email labels.")
-                rollback_multiple_emails_statuses(service, "me", emails)
+                label_mutations.remove_labels(email_ids, [PUBLISHED_LABEL_ID, PARSED_LABEL_ID])
+                label_mutations.add_labels(email_ids, ["UNREAD"])
 
             logging.info(f"Completed processing blogpost for {subject} newsletters.")
-            time.sleep(5)  # Sleep to avoid hitting API limits
+
+        # Failed subjects, and with --batch the ones that were only submitted or are still pending
+        posted_gmail_ids = set(gmail_ids_to_publish)
+        unfinished_subjects = {subject for subject in subjects_with_emails if not posted_gmail_ids.issuperset(gmail_ids_by_subject[subject])}
+        save_pending_checkpoints(pending_checkpoints, subjects, unfinished_subjects)
         
         if blogposts_to_commit:
             logging.info("Committing and pushing all generated blog posts in a single push...")
             pr_number = commit_and_push_all(blogposts_to_commit)
             merge_pull_request(pr_number)
-            apply_label_to_multiple_emails(service, "me", emails_to_update_labels, "Label_3076953365604997473")
+            label_mutations.add_labels(gmail_ids_to_publish, [PUBLISHED_LABEL_ID])
+            db_operations.mark_emails_published(gmail_ids_to_publish)
             logging.info(f"Blog posts committed and pushed successfully. PR Number: {pr_number}")
         else:
             logging.info("No blog posts generated. Skipping GitHub commit.")
 
+        if cache_stats:
+            logging.info(f"OpenAI response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses.")
         logging.info("All blog post generation completed successfully.")
 
     except HttpError as e:
         logging.error(f"Gmail API error: {e}")
     except Exception as e:
         logging.error(f"Unexpected error in main execution: {e}")
+    finally:
+        if service and len(label_mutations):
+            try:
+                label_mutations.flush(service)
+            except HttpError as e:
+                logging.error(f"Gmail API error while applying label changes: {e}")
 
 if __name__ == "__main__":
     db_operations.initialize_database()
-    main()
+    try:
+        main()
+    finally:
+        db_operations.close_database()
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from dotenv import load_dotenv
+
+load_dotenv("config/environment_variables.env")
+
+# Quotas per upstream, as (tokens per second, bucket capacity).
+# Gmail is metered in quota units (250 units per user per second), OpenAI and GitHub in requests.
+RATE_LIMITS = {
+    "gmail": (
+        float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250")),
+        float(os.getenv("GMAIL_QUOTA_UNITS_BURST", "250")),
+    ),
+    "openai": (
+        float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500")) / 60,
+        float(os.getenv("OPENAI_REQUESTS_BURST", "5")),
+    ),
+    "github": (
+        float(os.getenv("GITHUB_REQUESTS_PER_HOUR", "5000")) / 3600,
+        float(os.getenv("GITHUB_REQUESTS_BURST", "10")),
+    ),
+}
+
+# Gmail quota units per method, see https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_COSTS = {
+    "messages.get": 5,
+    "messages.list": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "messages.attachments.get": 5,
+    "history.list": 2,
+    "getProfile": 1,
+    "labels.create": 5,
+}
+
+MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# Error reasons Google APIs use for rate limiting on a 403
+GOOGLE_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+class TokenBucket:
+    """Thread-safe token bucket that refills continuously at `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available and takes them. Requests larger than the capacity are taken in parts."""
+        while tokens > 0:
+            part = min(tokens, self.capacity)
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self._paused_until and self._tokens >= part:
+                        self._tokens -= part
+                        break
+                    wait = max(self._paused_until - now, (part - self._tokens) / self.rate)
+                time.sleep(wait)
+            tokens -= part
+
+    def pause(self, seconds):
+        """Stops handing out tokens for `seconds`, e.g. after the upstream answered with a rate-limit error."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(upstream):
+    """Returns the shared token bucket of an upstream ("gmail", "openai" or "github")."""
+    with _buckets_lock:
+        if upstream not in _buckets:
+            rate, capacity = RATE_LIMITS[upstream]
+            _buckets[upstream] = TokenBucket(rate, capacity)
+        return _buckets[upstream]
+
+def backoff_delay(attempt, minimum=0.0, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """Exponential backoff with full jitter for the given attempt, never shorter than `minimum` seconds."""
+    return minimum + random.uniform(0, min(cap, base * 2 ** attempt))
+
+def parse_retry_after(value):
+    """Parses a Retry-After header (delta seconds or HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def get_rate_limit_delay(result):
+    """Returns the Retry-After delay (0 when absent) if `result` is a rate-limit error or response, otherwise None.
+
+    Understands googleapiclient HttpErrors, OpenAI API errors and `requests` responses,
+    and treats 429s and rate-limit 403s as rate limiting.
+    """
+    if result is None:
+        return None
+
+    # googleapiclient.errors.HttpError
+    resp = getattr(result, "resp", None)
+    if resp is not None and hasattr(resp, "status"):
+        status = int(resp.status)
+        content = getattr(result, "content", b"") or b""
+        if isinstance(content, bytes):
+            content = content.decode("utf-8", errors="ignore")
+        if status == 429 or (status == 403 and any(reason in content for reason in GOOGLE_RATE_LIMIT_REASONS)):
+            return parse_retry_after(resp.get("retry-after")) or 0.0
+        return None
+
+    # openai.APIStatusError carries the httpx response, a requests.Response is the result itself
+    response = result if hasattr(result, "headers") else getattr(result, "response", None)
+    status = getattr(result, "status_code", None) or getattr(response, "status_code", None)
+    headers = getattr(response, "headers", None) or {}
+    if status == 429:
+        return parse_retry_after(headers.get("retry-after")) or 0.0
+    if status == 403 and headers.get("x-ratelimit-remaining") == "0":
+        # GitHub's primary rate limit tells us when the window resets instead of sending Retry-After
+        retry_after = parse_retry_after(headers.get("retry-after"))
+        if retry_after is None and headers.get("x-ratelimit-reset"):
+            retry_after = max(0.0, float(headers["x-ratelimit-reset"]) - time.time())
+        return retry_after or 0.0
+    return None
+
+def call_with_rate_limit(upstream, func, cost=1, max_retries=MAX_RETRIES, transient_errors=()):
+    """Calls func() after acquiring `cost` tokens from the upstream's bucket.
+
+    Rate-limit errors and responses are retried with jittered exponential backoff, honouring
+    Retry-After; the whole upstream is paused meanwhile so other callers back off too.
+    Exceptions of the transient_errors types (e.g. server errors) are retried with backoff
+    as well, without pausing the upstream.
+    """
+    bucket = get_bucket(upstream)
+    for attempt in range(max_retries + 1):
+        bucket.acquire(cost)
+        try:
+            result = func()
+        except transient_errors as e:
+            if attempt == max_retries:
+                raise
+            wait = backoff_delay(attempt)
+            logging.warning(f"{upstream} request failed ({type(e).__name__}). Retrying in {wait:.1f}s (attempt {attempt + 1}/{max_retries}).")
+            time.sleep(wait)
+            continue
+        except Exception as e:
+            delay = get_rate_limit_delay(e)
+            if delay is None or attempt == max_retries:
+                raise
+        else:
+            delay = get_rate_limit_delay(result)
+            if delay is None or attempt == max_retries:
+                return result
+
+        wait = backoff_delay(attempt, minimum=delay)
+        logging.warning(f"Rate limited by {upstream}. Retrying in {wait:.1f}s (attempt {attempt + 1}/{max_retries}).")
+        bucket.pause(wait)
+
+async def call_with_rate_limit_async(upstream, func, cost=1, max_retries=MAX_RETRIES, transient_errors=()):
+    """Awaits func() after acquiring `cost` tokens from the upstream's bucket, for coroutine functions.
+
+    Shares the buckets and the retry behaviour of call_with_rate_limit. Waiting for tokens, including
+    the pause after a rate-limit error, happens in a worker thread so the event loop is never blocked.
+    """
+    bucket = get_bucket(upstream)
+    for attempt in range(max_retries + 1):
+        await asyncio.to_thread(bucket.acquire, cost)
+        try:
+            result = await func()
+        except transient_errors as e:
+            if attempt == max_retries:
+                raise
+            wait = backoff_delay(attempt)
+            logging.warning(f"{upstream} request failed ({type(e).__name__}). Retrying in {wait:.1f}s (attempt {attempt + 1}/{max_retries}).")
+            await asyncio.sleep(wait)
+            continue
+        except Exception as e:
+            delay = get_rate_limit_delay(e)
+            if delay is None or attempt == max_retries:
+                raise
+        else:
+            delay = get_rate_limit_delay(result)
+            if delay is None or attempt == max_retries:
+                return result
+
+        wait = backoff_delay(attempt, minimum=delay)
+        logging.warning(f"Rate limited by {upstream}. Retrying in {wait:.1f}s (attempt {attempt + 1}/{max_retries}).")
+        bucket.pause(wait)
+
+def execute_gmail_request(request, method="messages.get"):
+    """Executes a googleapiclient request against the Gmail quota, charging the method's quota units."""
+    return call_with_rate_limit("gmail", request.execute, GMAIL_QUOTA_COSTS.get(method, 5))